@@ -123,3 +123,56 @@ PIPELINE_JS = {
         'output_filename': 'js/application.js',
     },
 }
+
+# SurveyMonkey API client
+# get_responses batches fetched in parallel by Survey.download_responses
+SURVEYMONKEY_MAX_WORKERS = int(os.environ.get('SURVEYMONKEY_MAX_WORKERS', 4))
+# Batches requested or buffered at once (None means 2 per worker)
+SURVEYMONKEY_MAX_IN_FLIGHT = None
+# API quota of our SurveyMonkey plan, enforced across all clients
+# of a process (one worker); run a single sync worker to keep the
+# per-day budget exact
+SURVEYMONKEY_REQUESTS_PER_SECOND = float(os.environ.get('SURVEYMONKEY_REQUESTS_PER_SECOND', 2))
+SURVEYMONKEY_REQUESTS_PER_DAY = int(os.environ.get('SURVEYMONKEY_REQUESTS_PER_DAY', 1000))
+# Dotted path of a function returning the requests transport adapter
+# the client sends through, e.g., 'sm_fake.recorded_adapter' to work
+# offline against a fake SurveyMonkey. None means the real API
+SURVEYMONKEY_TRANSPORT = os.environ.get('SURVEYMONKEY_TRANSPORT')
+
+# Seconds after which a running SyncJob is considered abandoned
+# (e.g., its worker was restarted) and its survey can be synced again
+SYNC_JOB_TIMEOUT = 60 * 60
+
+# Comments shown per open-ended question before the reader scrolls,
+# and per page of the comments endpoint
+COMMENTS_PAGE_SIZE = 20
+
+# Cache for rendered reports, picked with REPORT_CACHE_BACKEND
+# Run manage.py createcachetable before using the db backend
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('REPORT_CACHE_LOCATION', '/tmp/l4g-report-cache'),
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'report_cache',
+    },
+}
+CACHES = {
+    'default': CACHE_BACKENDS[os.environ.get('REPORT_CACHE_BACKEND', 'locmem')],
+}
+# 'page' caches whole report pages, 'fragment' caches the NPS panel
+# and each question block separately, None turns caching off
+REPORT_CACHE = os.environ.get('REPORT_CACHE', 'page') or None
+REPORT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Margins of error on report figures: 'analytic' (normal approximation
+# for NPS, Wilson intervals for choice proportions), 'bootstrap'
+# (resampled, see report.intervals) or None for point estimates only
+REPORT_INTERVALS = os.environ.get('REPORT_INTERVALS', 'analytic') or None
+# Confidence level of the intervals, one of report.intervals.CONFIDENCE_Z
+REPORT_CONFIDENCE = 0.95
@@ -1,5 +1,53 @@
 from django.contrib import admin
-from .models import Survey, Question, Choice
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Case, When, F, FloatField, ExpressionWrapper
+from .models import Survey, Question, Choice, Respondent, Answer, SyncJob
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Paginator for tables too large to COUNT(*) on every
+    changelist page: an unfiltered PostgreSQL queryset is counted
+    from the planner's row estimate in pg_class, anything else
+    (filtered, searched, other backends, small tables) exactly
+    '''
+    # Below this many estimated rows an exact count is cheap enough
+    EXACT_BELOW = 10000
+
+    def _get_count(self):
+        if self._count is None:
+            estimate = self._estimate()
+            if estimate is not None and estimate >= self.EXACT_BELOW:
+                self._count = estimate
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+    def _estimate(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where:
+            return None
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [query.model._meta.db_table])
+            row = cursor.fetchone()
+        return int(row[0]) if row else None
+
+
+def refresh_report(survey, form, formsets, question_ids):
+    '''
+    After an admin edit, rebuild the rollups and the NPS trend if
+    the NPS flag or choices of question_ids changed (refresh_stats()
+    bumps report_version), or just move report_version for other
+    edits, so cached pages and ETags never outlive the change
+    '''
+    if question_ids:
+        survey.refresh_nps_trend()
+        survey.refresh_stats(question_ids)
+    elif form.has_changed() or any(formset.has_changed() for formset in formsets):
+        survey.bump_report_version()
 
 
 class QuestionInline(admin.TabularInline):
@@ -8,8 +56,52 @@ class QuestionInline(admin.TabularInline):
 
 
 class SurveyAdmin(admin.ModelAdmin):
-    list_display = ('name', 'net_promoter_score')
+    # NPS and counts come from the stats rollup joined into the
+    # changelist query, instead of the per-question NPS loop per row
+    list_display = ('name', 'nps', 'respondent_count', 'last_updated')
     inlines = [QuestionInline]
+    actions = ['queue_sync', 'queue_full_sync']
+
+    def get_queryset(self, request):
+        queryset = super(SurveyAdmin, self).get_queryset(request).select_related('stats')
+        # Sortable score, as computed by SurveyStats.net_promoter_score
+        score = ExpressionWrapper(
+            (F('stats__nps_promoters') - F('stats__nps_detractors')) * 100.0 / F('stats__nps_respondents'),
+            output_field=FloatField())
+        return queryset.annotate(nps_order=Case(When(stats__nps_respondents__gt=0, then=score)))
+
+    def save_related(self, request, form, formsets, change):
+        super(SurveyAdmin, self).save_related(request, form, formsets, change)
+        # Question ids touched through the inline, deleted ones
+        # included so the survey-wide NPS is recounted
+        question_ids = set()
+        for formset in formsets:
+            question_ids.update(obj.id for obj, fields in formset.changed_objects if 'nps' in fields)
+            question_ids.update(obj.id for obj in formset.new_objects + formset.deleted_objects)
+        refresh_report(form.instance, form, formsets, sorted(question_ids))
+
+    def nps(self, survey):
+        stats = getattr(survey, 'stats', None)
+        return stats.net_promoter_score if stats else None
+    nps.short_description = "Net Promoter Score"
+    nps.admin_order_field = 'nps_order'
+
+    def respondent_count(self, survey):
+        stats = getattr(survey, 'stats', None)
+        return stats.respondent_count if stats else 0
+    respondent_count.short_description = "Respondents"
+    respondent_count.admin_order_field = 'stats__respondent_count'
+
+    def queue_sync(self, request, queryset, incremental=True):
+        # The worker (manage.py sync_surveys --worker) runs the job
+        for survey in queryset:
+            SyncJob.enqueue(survey, incremental=incremental)
+        self.message_user(request, "Queued a sync for {} survey(s)".format(len(queryset)))
+    queue_sync.short_description = "Queue a sync of new responses"
+
+    def queue_full_sync(self, request, queryset):
+        self.queue_sync(request, queryset, incremental=False)
+    queue_full_sync.short_description = "Queue a full sync"
 
 
 class ChoiceInline(admin.TabularInline):
@@ -18,8 +110,50 @@ class ChoiceInline(admin.TabularInline):
 
 class QuestionAdmin(admin.ModelAdmin):
     list_display = ('text', 'survey', 'nps', 'open_ended')
+    list_select_related = ('survey',)
     inlines = [ChoiceInline]
 
+    def save_related(self, request, form, formsets, change):
+        super(QuestionAdmin, self).save_related(request, form, formsets, change)
+        question = form.instance
+        # Flagging NPS or editing choice weights changes the report figures
+        weights = any(
+            'weight' in fields for formset in formsets for obj, fields in formset.changed_objects
+        ) or any(formset.new_objects or formset.deleted_objects for formset in formsets)
+        changed = not change or 'nps' in form.changed_data or 'survey' in form.changed_data or weights
+        refresh_report(question.survey, form, formsets, [question.id] if changed else [])
+        if change and 'survey' in form.changed_data:
+            # The survey the question moved out of loses its answers
+            Survey.objects.get(pk=form.initial['survey']).refresh_stats([])
+
+
+class RespondentAdmin(admin.ModelAdmin):
+    list_display = ('sm_id', 'survey')
+    list_select_related = ('survey',)
+    search_fields = ('sm_id',)
+    raw_id_fields = ('survey', 'questions')
+    paginator = EstimatedCountPaginator
+    # Skip the second, unfiltered COUNT(*) of the changelist
+    show_full_result_count = False
+
+
+class AnswerAdmin(admin.ModelAdmin):
+    list_display = ('id', 'respondent', 'question', 'choice', 'text')
+    list_select_related = ('respondent', 'question', 'choice')
+    raw_id_fields = ('respondent', 'question', 'choice')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class SyncJobAdmin(admin.ModelAdmin):
+    list_display = ('survey', 'status', 'incremental', 'created', 'started', 'finished')
+    list_filter = ('status',)
+    list_select_related = ('survey',)
+    raw_id_fields = ('survey',)
+
 
 admin.site.register(Survey, SurveyAdmin)
 admin.site.register(Question, QuestionAdmin)
+admin.site.register(Respondent, RespondentAdmin)
+admin.site.register(Answer, AnswerAdmin)
+admin.site.register(SyncJob, SyncJobAdmin)
@@ -0,0 +1,247 @@
+from __future__ import division
+from itertools import chain
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from report.models import Choice, Respondent, Answer, NPS_PROMOTER_WEIGHTS, NPS_PASSIVE_WEIGHTS, NPS_DETRACTOR_WEIGHTS
+from report.reports import report_cache_key
+
+# Choice.weight stand-in for choices without a weight
+NO_WEIGHT = -1
+
+
+class ResponseMatrix(object):
+    '''
+    A survey's answers loaded once into arrays, so counts, NPS
+    and crosstabs are NumPy operations instead of ORM queries
+
+    Rows are respondents (respondent_ids, sorted), columns are
+    questions (question_ids) and choices (choice_ids, grouped by
+    question). Every answer with a choice is one entry of the
+    parallel arrays answer_rows/answer_choices, a sparse layout
+    that holds select-all questions as easily as select-one
+    ones. Comments are counted in text_rows/text_questions.
+    answered is the respondents x questions boolean matrix of
+    Respondent.questions
+
+    bitsets holds, for every choice, the respondents who picked
+    it as a packed bit array (8 respondents per byte), so segments
+    of respondents are a few bitwise operations away, see
+    report.segments
+
+    Build it with load() or, cached per report_version,
+    get_matrix()
+    '''
+    def __init__(self, respondent_ids, question_ids, question_nps, choice_ids, choice_questions,
+                 choice_weights, answer_rows, answer_choices, text_rows, text_questions, answered):
+        self.respondent_ids = respondent_ids
+        self.question_ids = question_ids
+        self.question_nps = question_nps
+        self.choice_ids = choice_ids
+        # Column in question_ids of each choice
+        self.choice_questions = choice_questions
+        self.choice_weights = choice_weights
+        self.answer_rows = answer_rows
+        self.answer_choices = answer_choices
+        self.text_rows = text_rows
+        self.text_questions = text_questions
+        self.answered = answered
+        self.bitsets = np.zeros((len(choice_ids), (len(respondent_ids) + 7) // 8), dtype=np.uint8)
+        np.bitwise_or.at(
+            self.bitsets, (answer_choices, answer_rows >> 3),
+            (128 >> (answer_rows & 7)).astype(np.uint8))
+
+    @classmethod
+    def load(cls, survey):
+        '''
+        Read survey's respondents, questions, choices, answers,
+        comments and respondent-question links in six queries. Ids
+        are streamed straight into arrays rather than kept as
+        Python tuples
+        '''
+        respondent_ids = np.sort(_int_array(
+            Respondent.objects.filter(survey_id=survey.id).values_list("id", flat=True)))
+        questions = list(survey.question_set.order_by("id").values_list("id", "nps"))
+        question_ids = np.array([q[0] for q in questions], dtype=np.int64)
+        question_nps = np.array([q[1] for q in questions], dtype=bool)
+        choices = list(Choice.objects.filter(question__survey_id=survey.id)
+                       .order_by("question_id", "id").values_list("id", "question_id", "weight"))
+        choice_ids = np.array([c[0] for c in choices], dtype=np.int64)
+        choice_questions = _index(question_ids, [c[1] for c in choices])
+        choice_weights = np.array([NO_WEIGHT if c[2] is None else c[2] for c in choices], dtype=np.int16)
+
+        pairs = _int_array(chain.from_iterable(
+            Answer.objects.filter(respondent__survey_id=survey.id, choice__isnull=False)
+            .order_by().values_list("respondent_id", "choice_id").iterator())).reshape(-1, 2)
+        answer_rows = _index(respondent_ids, pairs[:, 0])
+        answer_choices = _index(choice_ids, pairs[:, 1])
+
+        comments = _int_array(chain.from_iterable(
+            Answer.objects.filter(respondent__survey_id=survey.id, choice__isnull=True)
+            .order_by().values_list("respondent_id", "question_id").iterator())).reshape(-1, 2)
+        text_rows = _index(respondent_ids, comments[:, 0])
+        text_questions = _index(question_ids, comments[:, 1])
+
+        links = _int_array(chain.from_iterable(
+            Respondent.questions.through.objects.filter(respondent__survey_id=survey.id)
+            .values_list("respondent_id", "question_id").iterator())).reshape(-1, 2)
+        answered = np.zeros((len(respondent_ids), len(question_ids)), dtype=bool)
+        answered[_index(respondent_ids, links[:, 0]), _index(question_ids, links[:, 1])] = True
+
+        return cls(respondent_ids, question_ids, question_nps, choice_ids, choice_questions,
+                   choice_weights, answer_rows, answer_choices, text_rows, text_questions, answered)
+
+    def _get_shape(self):
+        return (len(self.respondent_ids), len(self.question_ids))
+    shape = property(_get_shape)
+
+    def choice_counts(self, rows=None):
+        '''
+        Answers per choice as an array aligned with choice_ids,
+        counting only respondents in rows (a boolean mask over
+        respondent_ids) if given
+        '''
+        choices = self.answer_choices
+        if rows is not None:
+            choices = choices[rows[self.answer_rows]]
+        return np.bincount(choices, minlength=len(self.choice_ids))
+
+    def question_answers(self, rows=None):
+        '''
+        Answers per question, comments included, aligned with
+        question_ids
+        '''
+        choices, text_questions = self.answer_choices, self.text_questions
+        if rows is not None:
+            choices = choices[rows[self.answer_rows]]
+            text_questions = text_questions[rows[self.text_rows]]
+        n = len(self.question_ids)
+        return (np.bincount(self.choice_questions[choices], minlength=n)
+                + np.bincount(text_questions, minlength=n))
+
+    def question_respondents(self, rows=None):
+        '''
+        Respondents per question, aligned with question_ids
+        '''
+        answered = self.answered if rows is None else self.answered[rows]
+        return answered.sum(axis=0)
+
+    def nps_totals(self, rows=None):
+        '''
+        Promoters, passives and detractors among the answers to
+        NPS questions, and respondents summed over NPS questions,
+        as Survey._nps_totals() counts them. None if no NPS
+        question was answered
+        '''
+        nps_choices = self.question_nps[self.choice_questions]
+        counts = self.choice_counts(rows) * nps_choices
+        # Distinct (respondent, NPS question) pairs among the answers
+        in_nps = nps_choices[self.answer_choices]
+        if rows is not None:
+            in_nps &= rows[self.answer_rows]
+        pairs = (self.answer_rows[in_nps].astype(np.int64) * len(self.question_ids)
+                 + self.choice_questions[self.answer_choices[in_nps]])
+        respondents = len(np.unique(pairs))
+        if not respondents:
+            return None
+        weights = self.choice_weights
+        return {
+            "promoters": int(counts[np.in1d(weights, NPS_PROMOTER_WEIGHTS)].sum()),
+            "passives": int(counts[np.in1d(weights, NPS_PASSIVE_WEIGHTS)].sum()),
+            "detractors": int(counts[np.in1d(weights, NPS_DETRACTOR_WEIGHTS)].sum()),
+            "respondents": respondents,
+        }
+
+    def choice_positions(self, choice_ids):
+        '''
+        Positions in choice_ids of the given choice ids
+        Raises KeyError for ids that are not choices of the survey
+        '''
+        choice_ids = np.asarray(choice_ids, dtype=np.int64)
+        if not np.in1d(choice_ids, self.choice_ids).all():
+            raise KeyError(choice_ids)
+        return _index(self.choice_ids, choice_ids)
+
+    def rows_of(self, bits):
+        '''
+        Boolean mask over respondent_ids of a packed bit array
+        like those in bitsets
+        '''
+        return np.unpackbits(bits)[:len(self.respondent_ids)].astype(bool)
+
+    def code_matrix(self):
+        '''
+        Dense respondents x questions int16 matrix of the position
+        of the picked choice within its question, -1 where there
+        is no choice answer. Select-all questions keep one of the
+        picks here; use indicator() for all of them
+        '''
+        first_choices = np.searchsorted(self.choice_questions, np.arange(len(self.question_ids)))
+        columns = self.choice_questions[self.answer_choices]
+        codes = np.empty(self.shape, dtype=np.int16)
+        codes.fill(-1)
+        codes[self.answer_rows, columns] = self.answer_choices - first_choices[columns]
+        return codes
+
+    def weight_matrix(self):
+        '''
+        Like code_matrix() but holding choice weights, as floats
+        with NaN where there is no weighted answer, ready for
+        np.nanmean(), np.corrcoef() and the like
+        '''
+        weights = np.empty(self.shape)
+        weights.fill(np.nan)
+        picked = self.choice_weights[self.answer_choices]
+        weighted = picked != NO_WEIGHT
+        weights[self.answer_rows[weighted], self.choice_questions[self.answer_choices[weighted]]] = picked[weighted]
+        return weights
+
+    def indicator(self, question_id):
+        '''
+        Respondents x choices boolean matrix of who picked which
+        choice of a question, and the ids of those choices
+        '''
+        column = np.searchsorted(self.question_ids, question_id)
+        first, last = np.searchsorted(self.choice_questions, [column, column + 1])
+        picked = np.zeros((len(self.respondent_ids), last - first), dtype=bool)
+        in_question = (self.answer_choices >= first) & (self.answer_choices < last)
+        picked[self.answer_rows[in_question], self.answer_choices[in_question] - first] = True
+        return picked, self.choice_ids[first:last]
+
+    def crosstab(self, question_id, by_question_id, rows=None):
+        '''
+        Respondents who picked each pair of choices of two
+        questions: a matrix with a row per choice of question_id
+        and a column per choice of by_question_id, along with the
+        choice ids of both
+        '''
+        a, a_ids = self.indicator(question_id)
+        b, b_ids = self.indicator(by_question_id)
+        if rows is not None:
+            a, b = a[rows], b[rows]
+        return np.dot(a.T.astype(np.int64), b.astype(np.int64)), a_ids, b_ids
+
+
+def get_matrix(survey):
+    '''
+    ResponseMatrix of survey, from the cache while its
+    report_version is unchanged
+    '''
+    key = report_cache_key(survey, "matrix")
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = ResponseMatrix.load(survey)
+        cache.set(key, matrix, settings.REPORT_CACHE_TIMEOUT)
+    return matrix
+
+
+def _int_array(values):
+    return np.fromiter(values, dtype=np.int64)
+
+
+def _index(ids, values):
+    '''
+    Positions of values in ids, which need not be sorted
+    '''
+    order = np.argsort(ids, kind="mergesort")
+    return order[np.searchsorted(ids, values, sorter=order)].astype(np.int32)
@@ -0,0 +1,71 @@
+import json
+import unicodecsv
+from report.models import Answer
+
+# Answers read per keyset query while streaming an export
+EXPORT_CHUNK_SIZE = 2000
+
+# One row per answer, respondents and questions by SurveyMonkey ID
+EXPORT_COLUMNS = [
+    "respondent_id",
+    "question_id",
+    "question",
+    "choice_id",
+    "choice",
+    "weight",
+    "text",
+]
+
+
+def iter_answer_rows(survey, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Every answer of survey as a tuple of EXPORT_COLUMNS values
+
+    Rows are read chunk_size at a time with keyset pagination on
+    Answer.id (WHERE id > last ORDER BY id LIMIT chunk_size), so
+    memory stays flat however large the survey is and the first
+    rows are available after one short query. Neither iterator()
+    nor a plain psycopg2 cursor avoid loading the whole result
+    client-side
+    '''
+    answers = Answer.objects.filter(respondent__survey_id=survey.id).order_by("id")
+    fields = (
+        "id", "respondent__sm_id", "question__sm_id", "question__text",
+        "choice__sm_id", "choice__text", "choice__weight", "text",
+    )
+    last = None
+    while True:
+        chunk = answers if last is None else answers.filter(id__gt=last)
+        rows = list(chunk.values_list(*fields)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+def csv_stream(rows):
+    '''
+    Encoded CSV lines for rows, header first
+    '''
+    writer = unicodecsv.writer(_Echo(), encoding="utf-8")
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_stream(rows):
+    '''
+    One JSON object per row and line
+    '''
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+
+
+class _Echo(object):
+    '''
+    File-like object for csv writers that hands back what is
+    written instead of buffering it
+    '''
+    def write(self, value):
+        return value
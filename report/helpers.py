@@ -1,3 +1,7 @@
+from __future__ import division
+from datetime import timedelta
+
+
 def str_truncate(string):
     '''
     If a string is longer than 30 characters, add
@@ -7,3 +11,51 @@ def str_truncate(string):
         return u'{}...'.format(string[:30])
     else:
         return string
+
+
+def chunked(iterable, size):
+    '''
+    Break an iterable (including generators) into lists
+    of at most size elements, without loading the whole
+    iterable into memory
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def rounded_percentage(count, total):
+    '''
+    Share of count over total as a whole-number
+    percentage, or None if total is empty
+    '''
+    if total:
+        return int(round(count / total * 100))
+
+
+def nps_score(promoters, detractors, respondents):
+    '''
+    Net Promoter Score: promoters % minus detractors %,
+    multiplied by 100 and rounded, from -100 to 100
+    See calculation method here: https://www.netpromoter.com/know/
+    '''
+    if respondents:
+        raw_score = promoters / respondents - detractors / respondents
+        return int(round(raw_score * 100))
+
+
+def period_start(day, period):
+    '''
+    First date of the "day", "week" (starting Monday)
+    or "month" that contains date day
+    '''
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
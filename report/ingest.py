@@ -0,0 +1,320 @@
+from __future__ import division
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+from report.helpers import chunked
+from report.models import Question, Choice, Respondent, Answer
+from sm_api import SurveyMonkeyClient
+
+logger = logging.getLogger(__name__)
+
+# Number of respondents written per bulk_create round
+CHUNK_SIZE = 500
+
+
+def ingest_responses(survey, responses, chunk_size=CHUNK_SIZE, modified_since=None):
+    '''
+    Batched replacement for the per-answer get_or_create loop
+
+    responses is any iterable of response dicts as returned by
+    SurveyMonkeyClient.get_responses(), e.g.,
+        {"respondent_id": "123", "questions": [
+            {"question_id": "456", "answers": [{"row": "789"}]}
+        ]}
+    It is consumed chunk_size respondents at a time, so a
+    generator keeps memory bounded for large surveys.
+
+    Question and choice sm_id maps are loaded once, existing
+    respondents are diffed in one query, and Respondent, the
+    Respondent-Question M2M and Answer rows are written with
+    bulk_create inside a single transaction.
+
+    Respondents that already exist are skipped, unless modified_since
+    (a SurveyMonkeyClient.DATE_FORMAT string) is given and their
+    "date_modified" is after it: those edited submissions have
+    their answers replaced.
+
+    New respondents are stamped with their "date_modified" as
+    Respondent.submitted, which is also filled in for existing
+    respondents that lack it.
+
+    Returns a dict of row counts, ids of the questions that got
+    new or replaced rows, the (local) days those respondents were
+    submitted on, the latest "date_modified" seen, elapsed seconds
+    and rows/second. Its "deltas" are the net rows added per
+    question and choice, for Survey.apply_stats_deltas():
+        {"respondents": 2,
+         "links": Counter({question id: respondent-question links}),
+         "answers": Counter({question id: answers}),
+         "answered": Counter({question id: respondents with answers}),
+         "choices": Counter({choice id: answers})}
+    '''
+    start = time.time()
+    # order_by() drops the default ordering, which would join Survey
+    question_ids = dict(survey.question_set.order_by().values_list("sm_id", "id"))
+    choice_ids = {}
+    for question_id, sm_id, choice_id in Choice.objects.filter(
+            question__survey_id=survey.id).values_list("question_id", "sm_id", "id"):
+        choice_ids[(question_id, sm_id)] = choice_id
+    existing = {}
+    submitted = {}
+    for sm_id, respondent_id, respondent_submitted in survey.respondent_set.values_list("sm_id", "id", "submitted"):
+        existing[sm_id] = respondent_id
+        submitted[respondent_id] = respondent_submitted
+    RespondentQuestion = Respondent.questions.through
+    stats = {"respondents": 0, "replaced": 0, "respondent_questions": 0, "answers": 0, "skipped": 0}
+    touched = set()
+    days = set()
+    last_modified = None
+    deltas = {"respondents": 0, "links": Counter(), "answers": Counter(), "answered": Counter(), "choices": Counter()}
+
+    with transaction.atomic():
+        for batch in chunked(responses, chunk_size):
+            new = []
+            edited = []
+            stamped = []
+            queued = set()
+            for r in batch:
+                modified = r.get("date_modified")
+                if modified and (last_modified is None or modified > last_modified):
+                    last_modified = modified
+                # The respondent list can shift between pages during a
+                # sync and repeat a respondent; write each one once
+                if r["respondent_id"] in queued:
+                    stats["skipped"] += 1
+                    continue
+                queued.add(r["respondent_id"])
+                if r["respondent_id"] not in existing:
+                    existing[r["respondent_id"]] = None
+                    new.append(r)
+                    if modified:
+                        days.add(_local_day(_parse_date(modified)))
+                    continue
+                is_edited = modified_since and modified and modified > modified_since
+                respondent_id = existing[r["respondent_id"]]
+                if respondent_id is not None and modified and submitted.get(respondent_id) is None:
+                    # Downloaded before submission dates were kept
+                    submitted[respondent_id] = _parse_date(modified)
+                    stamped.append(Respondent(id=respondent_id, submitted=submitted[respondent_id]))
+                    days.add(_local_day(submitted[respondent_id]))
+                elif is_edited and submitted.get(respondent_id):
+                    days.add(_local_day(submitted[respondent_id]))
+                if is_edited:
+                    edited.append(r)
+                else:
+                    stats["skipped"] += 1
+            _bulk_update(Respondent, stamped, ["submitted"], chunk_size)
+            if not (new or edited):
+                continue
+            respondent_ids = {}
+            if new:
+                created = [
+                    Respondent(sm_id=r["respondent_id"], survey_id=survey.id,
+                               submitted=_parse_date(r["date_modified"]) if r.get("date_modified") else None)
+                    for r in new
+                ]
+                Respondent.objects.bulk_create(created, batch_size=chunk_size)
+                # bulk_create does not hand back primary keys on every
+                # backend, so read them back for this chunk in one query
+                respondent_ids = dict(survey.respondent_set.filter(
+                    sm_id__in=[r["respondent_id"] for r in new]).values_list("sm_id", "id"))
+                existing.update(respondent_ids)
+                for respondent in created:
+                    submitted[respondent_ids[respondent.sm_id]] = respondent.submitted
+            if edited:
+                # Drop what edited respondents said before, their
+                # current answers are written below like new ones
+                replaced_ids = [existing[r["respondent_id"]] for r in edited]
+                old_answers = Answer.objects.filter(respondent_id__in=replaced_ids)
+                old_links = RespondentQuestion.objects.filter(respondent_id__in=replaced_ids)
+                # Take the dropped rows off the rollup deltas
+                answered = set()
+                for respondent_id, question_id, choice_id in old_answers.values_list(
+                        "respondent_id", "question_id", "choice_id"):
+                    touched.add(question_id)
+                    answered.add((respondent_id, question_id))
+                    deltas["answers"][question_id] -= 1
+                    if choice_id is not None:
+                        deltas["choices"][choice_id] -= 1
+                deltas["answered"].subtract(question_id for respondent_id, question_id in answered)
+                deltas["links"].subtract(old_links.values_list("question_id", flat=True))
+                old_answers.delete()
+                old_links.delete()
+                for r in edited:
+                    respondent_ids[r["respondent_id"]] = existing[r["respondent_id"]]
+            links = []
+            answers = []
+            for r in new + edited:
+                respondent_id = respondent_ids[r["respondent_id"]]
+                linked = set()
+                seen = set()
+                for q in r["questions"]:
+                    question_id = question_ids.get(q["question_id"])
+                    # Question removed from survey (or update_details()
+                    # never ran), nothing to attach the answers to
+                    if question_id is None:
+                        continue
+                    if question_id not in linked:
+                        linked.add(question_id)
+                        touched.add(question_id)
+                        links.append(RespondentQuestion(
+                            respondent_id=respondent_id, question_id=question_id))
+                    for raw_answer in q["answers"]:
+                        # Same rules as the original loop: "text" means
+                        # a comment, otherwise "col" then "row" point
+                        # to the choice that was selected
+                        if "text" in raw_answer:
+                            key = (question_id, None, raw_answer["text"])
+                        else:
+                            choice_sm_id = raw_answer.get("col") or raw_answer.get("row")
+                            choice_id = choice_ids.get((question_id, choice_sm_id))
+                            if choice_id is None:
+                                continue
+                            key = (question_id, choice_id, None)
+                        # get_or_create used to collapse duplicate answers
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        answers.append(Answer(
+                            question_id=question_id,
+                            choice_id=key[1],
+                            respondent_id=respondent_id,
+                            text=key[2],
+                        ))
+                        deltas["answers"][question_id] += 1
+                        if key[1] is not None:
+                            deltas["choices"][key[1]] += 1
+                deltas["answered"].update(set(key[0] for key in seen))
+                deltas["links"].update(linked)
+            RespondentQuestion.objects.bulk_create(links, batch_size=chunk_size)
+            Answer.objects.bulk_create(answers, batch_size=chunk_size)
+            stats["respondents"] += len(new)
+            deltas["respondents"] += len(new)
+            stats["replaced"] += len(edited)
+            stats["respondent_questions"] += len(links)
+            stats["answers"] += len(answers)
+
+    elapsed = time.time() - start
+    rows = stats["respondents"] + stats["respondent_questions"] + stats["answers"]
+    # Questions with new rows, for Survey.refresh_stats()
+    stats["question_ids"] = sorted(touched)
+    stats["deltas"] = deltas
+    # Days to rebuild with Survey.refresh_nps_trend()
+    stats["days"] = sorted(days)
+    # High-water mark for the next incremental sync
+    stats["last_modified"] = last_modified
+    stats["seconds"] = elapsed
+    stats["rows_per_second"] = rows / elapsed if elapsed else rows
+    logger.info(
+        "Ingested %d rows for survey %s in %.2fs (%.0f rows/s)",
+        rows, survey.pk, elapsed, stats["rows_per_second"])
+    return stats
+
+
+def sync_schema(survey, pages, batch_size=CHUNK_SIZE):
+    '''
+    Bulk replacement for the per-question/per-choice get_or_create
+    loop in Survey.update_details()
+
+    pages is the list returned by SurveyMonkeyClient.get_survey_details().
+    Existing questions and choices are loaded keyed by sm_id in two
+    queries, then new ones are inserted with bulk_create and changed
+    ones updated in batches. Choices are matched on sm_id alone, so
+    editing a choice's text or weight updates it in place instead of
+    creating a duplicate.
+
+    Returns the ids of questions that were created, got new
+    choices or had the weights of their NPS choices changed, for
+    Survey.refresh_stats(), and whether any NPS choice weight
+    changed, which moves the NPS of every day already bucketed
+    (see Survey.refresh_nps_trend())
+    '''
+    # Flatten the API payload, skipping descriptive text and
+    # choices without text, as update_details() always has
+    wanted = []
+    for p in pages:
+        for q in p["questions"]:
+            if q["type"]["subtype"] == "descriptive_text":
+                continue
+            answers = [(a["answer_id"], a["text"], a.get("weight")) for a in q["answers"] if a["text"]]
+            wanted.append((q["question_id"], q["heading"], q["type"]["family"] == u'open_ended', answers))
+
+    questions = {}
+    for question in survey.question_set.order_by("id"):
+        questions.setdefault(question.sm_id, question)
+    choices = {}
+    # Older versions of update_details() could create several choices
+    # with one sm_id; keep using the oldest
+    for choice in Choice.objects.filter(question__survey_id=survey.id).order_by("id"):
+        choices.setdefault((choice.question_id, choice.sm_id), choice)
+    changed = set()
+    nps_changed = False
+
+    with transaction.atomic():
+        new_questions = []
+        updated_questions = []
+        for qid, text, open_ended, answers in wanted:
+            question = questions.get(qid)
+            if question is None:
+                new_questions.append(Question(sm_id=qid, text=text, open_ended=open_ended, survey_id=survey.id))
+            elif (question.text, question.open_ended) != (text, open_ended):
+                question.text = text
+                question.open_ended = open_ended
+                updated_questions.append(question)
+        if new_questions:
+            Question.objects.bulk_create(new_questions, batch_size=batch_size)
+            # Read back primary keys, see ingest_responses()
+            for question in survey.question_set.filter(sm_id__in=[q.sm_id for q in new_questions]):
+                questions[question.sm_id] = question
+                changed.add(question.id)
+        _bulk_update(Question, updated_questions, ["text", "open_ended"], batch_size)
+
+        new_choices = []
+        updated_choices = []
+        for qid, text, open_ended, answers in wanted:
+            question_id = questions[qid].id
+            nps = questions[qid].nps
+            for cid, choice_text, weight in answers:
+                choice = choices.get((question_id, cid))
+                if choice is None:
+                    new_choices.append(Choice(sm_id=cid, text=choice_text, weight=weight, question_id=question_id))
+                    changed.add(question_id)
+                elif (choice.text, choice.weight) != (choice_text, weight):
+                    if nps and choice.weight != weight:
+                        nps_changed = True
+                        changed.add(question_id)
+                    choice.text = choice_text
+                    choice.weight = weight
+                    updated_choices.append(choice)
+        Choice.objects.bulk_create(new_choices, batch_size=batch_size)
+        _bulk_update(Choice, updated_choices, ["text", "weight"], batch_size)
+    return changed, nps_changed
+
+
+def _parse_date(value):
+    '''
+    Aware datetime of a SurveyMonkey date string (UTC)
+    '''
+    return timezone.make_aware(datetime.strptime(value, SurveyMonkeyClient.DATE_FORMAT), timezone.utc)
+
+
+def _local_day(value):
+    return timezone.localtime(value).date()
+
+
+def _bulk_update(model, objs, fields, batch_size):
+    '''
+    Write fields of already saved objs with one UPDATE per batch,
+    using CASE WHEN id = ... THEN ... to set per-row values
+    '''
+    for batch in chunked(objs, batch_size):
+        values = {}
+        for field in fields:
+            output_field = model._meta.get_field(field)
+            cases = [When(pk=obj.pk, then=Value(getattr(obj, field))) for obj in batch]
+            values[field] = Case(*cases, output_field=output_field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**values)
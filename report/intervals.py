@@ -0,0 +1,108 @@
+from __future__ import division
+import numpy as np
+
+# Normal quantiles of the supported REPORT_CONFIDENCE levels
+CONFIDENCE_Z = {
+    0.80: 1.2816,
+    0.90: 1.6449,
+    0.95: 1.9600,
+    0.99: 2.5758,
+}
+
+# Resamples drawn per estimate in bootstrap mode
+BOOTSTRAP_DRAWS = 1000
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    '''
+    Wilson score interval of the proportions successes / trials,
+    elementwise over arrays of counts. Unlike the normal
+    approximation it stays within 0..1 and is sensible for small
+    samples and proportions near 0 or 1. NaN where trials is 0
+    '''
+    z = CONFIDENCE_Z[confidence]
+    trials = np.asarray(trials, dtype=float)
+    successes = np.minimum(successes, trials)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = successes / trials
+        denominator = 1 + z ** 2 / trials
+        centre = (p + z ** 2 / (2 * trials)) / denominator
+        half_width = z * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return np.clip(centre - half_width, 0, 1), np.clip(centre + half_width, 0, 1)
+
+
+def nps_interval(promoters, detractors, respondents, confidence=0.95):
+    '''
+    Normal-approximation interval of the Net Promoter Score
+    (-100 to 100), elementwise over arrays of counts. A
+    respondent scores +1 as a promoter, 0 as a passive and -1 as
+    a detractor, so the score's variance is
+        (promoters% + detractors% - NPS%^2) / respondents
+    NaN where there are no respondents
+    '''
+    z = CONFIDENCE_Z[confidence]
+    respondents = np.asarray(respondents, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.asarray(promoters) / respondents
+        d = np.asarray(detractors) / respondents
+        score = p - d
+        error = z * np.sqrt((p + d - score ** 2) / respondents)
+    return np.clip((score - error) * 100, -100, 100), np.clip((score + error) * 100, -100, 100)
+
+
+def bootstrap_nps(promoters, detractors, respondents, confidence=0.95, draws=BOOTSTRAP_DRAWS, seed=0):
+    '''
+    Percentile bootstrap interval of the Net Promoter Score,
+    elementwise over arrays of counts. Resampling respondents
+    with replacement only changes how many fall in each group,
+    so each of the draws is a promoter count drawn binomially
+    and a detractor count drawn from the rest, for every score
+    at once; there is no loop over respondents or draws.
+    seed keeps intervals, and so cached pages, stable
+    '''
+    random = np.random.RandomState(seed)
+    respondents = np.asarray(respondents, dtype=np.int64)
+    promoters = np.asarray(promoters, dtype=np.int64)[..., None]
+    trials = np.maximum(respondents, 1)[..., None]
+    p = promoters / trials
+    # Share of detractors among non-promoters
+    d = np.asarray(detractors)[..., None] / np.maximum(trials - promoters, 1)
+    size = respondents.shape + (draws,)
+    boot_promoters = random.binomial(trials, p, size=size)
+    boot_detractors = random.binomial(trials - boot_promoters, d, size=size)
+    scores = (boot_promoters - boot_detractors) / trials * 100
+    return _percentile_interval(scores, respondents, confidence)
+
+
+def bootstrap_proportions(successes, trials, confidence=0.95, draws=BOOTSTRAP_DRAWS, seed=0):
+    '''
+    Percentile bootstrap interval of the proportions
+    successes / trials, elementwise over 1-d arrays of counts,
+    with every draw of every proportion made in one binomial
+    call. Sampling dominates the cost, so repeated
+    (successes, trials) pairs, e.g., unpicked choices, are
+    resampled once. NaN where trials is 0
+    '''
+    random = np.random.RandomState(seed)
+    trials = np.asarray(trials, dtype=np.int64)
+    successes = np.minimum(successes, trials)
+    pairs, inverse = np.unique(trials * (successes.max() + 1 if len(successes) else 1) + successes,
+                               return_inverse=True)
+    first = np.zeros(len(pairs), dtype=np.int64)
+    first[inverse] = np.arange(len(inverse))
+    unique_trials = np.maximum(trials[first], 1)[:, None]
+    p = successes[first][:, None] / unique_trials
+    samples = random.binomial(unique_trials, p, size=(len(pairs), draws)) / unique_trials
+    low, high = _percentile_interval(samples, trials[first], confidence)
+    return low[inverse], high[inverse]
+
+
+def _percentile_interval(samples, trials, confidence):
+    '''
+    Bounds of the central confidence share of samples along
+    their last axis, NaN where trials is 0
+    '''
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(samples, [tail, 100 - tail], axis=-1)
+    empty = trials == 0
+    return np.where(empty, np.nan, low), np.where(empty, np.nan, high)
@@ -0,0 +1,135 @@
+from __future__ import division
+import json
+import resource
+import time
+from datetime import datetime
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from report import views
+from report.models import Survey
+from report.reports import report_cache_key
+from sm_fake import fake_client, generate_survey
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark ingestion and report rendering on synthetic surveys "
+        "served by the fake SurveyMonkey, writing results as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--respondents', nargs='+', type=int, default=[100, 1000],
+                            dest='respondents', help="Respondent counts to benchmark, one run each")
+        parser.add_argument('--questions', type=int, default=10, dest='questions')
+        parser.add_argument('--choices', type=int, default=5, dest='choices',
+                            help="Choices per select question")
+        parser.add_argument('--open-ended', type=float, default=0.1, dest='open_ended',
+                            help="Share of questions that are comment boxes")
+        parser.add_argument('--repeat', type=int, default=5, dest='repeat',
+                            help="Renders timed per page, the median is reported")
+        parser.add_argument('--max-workers', type=int, default=1, dest='max_workers',
+                            help="Concurrent get_responses batches")
+        parser.add_argument('--latency', type=float, default=0, dest='latency',
+                            help="Seconds the fake API waits before each answer")
+        parser.add_argument('--label', default='', dest='label',
+                            help="Free text stored with the results, e.g., a version")
+        parser.add_argument('--output', default='bench_report.json', dest='output')
+        parser.add_argument('--keep', action='store_true', dest='keep',
+                            help="Keep the synthetic surveys instead of deleting them")
+
+    def handle(self, *args, **options):
+        results = {
+            "label": options['label'],
+            "created": datetime.utcnow().isoformat(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "params": dict((key, options[key]) for key in (
+                'questions', 'choices', 'open_ended', 'repeat', 'max_workers', 'latency')),
+            "runs": [],
+        }
+        for n_respondents in options['respondents']:
+            run = self.bench(n_respondents, options)
+            results["runs"].append(run)
+            self.stdout.write(
+                u"{respondents} respondents: ingested in {seconds:.2f}s "
+                u"({queries} queries), report in {render:.1f}ms ({render_queries} queries)".format(
+                    respondents=n_respondents,
+                    seconds=run["update_details"]["seconds"] + run["download_responses"]["seconds"],
+                    queries=run["update_details"]["queries"] + run["download_responses"]["queries"],
+                    render=run["survey_detail"]["ms"],
+                    render_queries=run["survey_detail"]["queries"]))
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write(u"Results written to {}".format(options['output']))
+
+    def bench(self, n_respondents, options):
+        '''
+        Ingest one synthetic survey of n_respondents and time its pages
+        '''
+        name = u"Benchmark survey {}".format(n_respondents)
+        fake = generate_survey(
+            name=name, survey_id=str(n_respondents), n_questions=options['questions'],
+            n_choices=options['choices'], n_respondents=n_respondents,
+            open_ended_share=options['open_ended'])
+        client = fake_client([fake], max_workers=options['max_workers'], latency=options['latency'])
+        survey = Survey.objects.create(name=name)
+        survey.get_client = lambda: client
+        try:
+            run = {"respondents": n_respondents}
+            run["update_details"], changed = self.measure(survey.update_details)
+            # NPS questions are flagged in the admin; flag the one
+            # generate_survey() puts first so NPS work is measured
+            survey.question_set.filter(sm_id="%s0000" % fake.survey_id).update(nps=True)
+            run["download_responses"], stats = self.measure(survey.download_responses)
+            run["download_responses"]["rows_per_second"] = stats["rows_per_second"]
+            # Peak resident size of the whole process so far
+            # (kilobytes on Linux), it never goes down between runs
+            run["peak_memory_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            run["api_requests"] = len(client.adapter.calls)
+            run["survey_detail"] = self.render(
+                views.SurveyDetail, options['repeat'], self.report_keys(survey), pk=survey.pk)
+            run["survey_list"] = self.render(views.SurveyList, options['repeat'], [])
+        finally:
+            if not options['keep']:
+                survey.delete()
+        return run
+
+    def measure(self, func):
+        '''
+        Seconds and queries taken by func(), and what it returned
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            result = func()
+            seconds = time.time() - start
+        return {"seconds": seconds, "queries": len(queries)}, result
+
+    def report_keys(self, survey):
+        '''
+        Cache keys a render of survey's report page may fill
+        (whole page or fragments, see settings.REPORT_CACHE)
+        '''
+        survey = Survey.objects.get(pk=survey.pk)
+        parts = [("page",), ("fragment", "nps"), ("fragment", "questions")]
+        return [report_cache_key(survey, *p) for p in parts]
+
+    def render(self, view, repeat, cache_keys, **kwargs):
+        '''
+        Median milliseconds and queries of rendering view with
+        cache_keys deleted from the cache first, leaving other
+        entries of the configured cache alone
+        '''
+        view = view.as_view()
+        timings = []
+        for n in range(max(repeat, 1)):
+            cache.delete_many(cache_keys)
+            request = RequestFactory().get('/')
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                view(request, **kwargs).render()
+                timings.append((time.time() - start) * 1000)
+        return {"ms": sorted(timings)[len(timings) // 2], "queries": len(queries)}
@@ -0,0 +1,51 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from report.models import Survey, SyncJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue SurveyMonkey refreshes for surveys (by ID or --all), "
+        "and/or process the queue with --worker"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int,
+                            help="IDs of surveys to queue")
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help="Queue every survey")
+        parser.add_argument('--full', action='store_true', dest='full',
+                            help="Download all responses instead of only those modified since the last sync")
+        parser.add_argument('--worker', action='store_true', dest='worker',
+                            help="Run queued jobs, polling for new ones")
+        parser.add_argument('--burst', action='store_true', dest='burst',
+                            help="With --worker, exit once the queue is empty")
+        parser.add_argument('--poll', type=float, default=5, dest='poll',
+                            help="Seconds between queue checks when idle")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if not options['all']:
+            surveys = surveys.filter(pk__in=options['survey_ids'])
+            missing = set(options['survey_ids']) - set(surveys.values_list('pk', flat=True))
+            if missing:
+                raise CommandError("No survey with ID {}".format(", ".join(str(pk) for pk in sorted(missing))))
+        for survey in surveys:
+            job = SyncJob.enqueue(survey, incremental=not options['full'])
+            self.stdout.write(u"Queued job {job} for {survey}".format(job=job.pk, survey=survey))
+
+        if options['worker']:
+            self.work(options['burst'], options['poll'])
+
+    def work(self, burst, poll):
+        while True:
+            job = SyncJob.claim_next()
+            if job is None:
+                if burst:
+                    return
+                time.sleep(poll)
+                continue
+            self.stdout.write(u"Syncing {survey} (job {job})".format(survey=job.survey, job=job.pk))
+            job.run()
+            self.stdout.write(u"Job {job} {status} in {duration:.1f}s".format(
+                job=job.pk, status=job.status, duration=job.duration))
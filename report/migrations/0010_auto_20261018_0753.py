@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0009_auto_20151128_1806'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChoiceStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('answer_count', models.IntegerField(default=0)),
+                ('raw_percentage', models.FloatField(default=0)),
+                ('choice', models.OneToOneField(related_name='stats', to='report.Choice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuestionStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('respondent_count', models.IntegerField(default=0)),
+                ('answer_count', models.IntegerField(default=0)),
+                ('question', models.OneToOneField(related_name='stats', to='report.Question')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SurveyStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('respondent_count', models.IntegerField(default=0)),
+                ('question_count', models.IntegerField(default=0)),
+                ('nps_respondents', models.IntegerField(null=True)),
+                ('nps_promoters', models.IntegerField(null=True)),
+                ('nps_passives', models.IntegerField(null=True)),
+                ('nps_detractors', models.IntegerField(null=True)),
+                ('refreshed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='survey',
+            options={'ordering': ['last_updated', 'name']},
+        ),
+        migrations.AddField(
+            model_name='surveystats',
+            name='survey',
+            field=models.OneToOneField(related_name='stats', to='report.Survey'),
+        ),
+        migrations.AddField(
+            model_name='questionstats',
+            name='survey',
+            field=models.ForeignKey(to='report.Survey'),
+        ),
+        migrations.AddField(
+            model_name='choicestats',
+            name='survey',
+            field=models.ForeignKey(to='report.Survey'),
+        ),
+    ]
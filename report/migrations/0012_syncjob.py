@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0011_survey_last_response_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('incremental', models.BooleanField(default=True)),
+                ('status', models.CharField(default=b'queued', max_length=10, db_index=True, choices=[(b'queued', b'Queued'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('error_message', models.TextField(null=True)),
+                ('survey', models.ForeignKey(to='report.Survey')),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
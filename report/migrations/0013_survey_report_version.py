@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0012_syncjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='report_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def duplicates(model, fields):
+    '''
+    {duplicate id: id of the oldest row with the same fields}
+    '''
+    merge = {}
+    groups = model.objects.values(*fields).annotate(n=Count('id'), keep=Min('id')).filter(n__gt=1).order_by()
+    for group in groups:
+        keep = group.pop('keep')
+        group.pop('n')
+        for pk in model.objects.filter(**group).exclude(pk=keep).values_list('id', flat=True):
+            merge[pk] = keep
+    return merge
+
+
+def repoint(model, field, merge):
+    for duplicate, keep in merge.items():
+        model.objects.filter(**{field: duplicate}).update(**{field: keep})
+
+
+def repoint_links(link, field, other, merge):
+    '''
+    Move respondent-question links onto the kept row, dropping
+    those it already has so (respondent, question) stays unique
+    '''
+    for duplicate, keep in merge.items():
+        linked = list(link.objects.filter(**{field: keep}).values_list(other, flat=True))
+        link.objects.filter(**{field: duplicate, other + '__in': linked}).delete()
+        link.objects.filter(**{field: duplicate}).update(**{field: keep})
+
+
+def merge_duplicates(apps, schema_editor):
+    '''
+    Older versions of update_details() and download_responses()
+    could store one SurveyMonkey object several times. Fold each
+    set of duplicates into its oldest row so the unique
+    constraints of the next migration can be added. Stats rollups
+    of merged rows are dropped; the next sync rebuilds them
+    '''
+    Question = apps.get_model('report', 'Question')
+    Choice = apps.get_model('report', 'Choice')
+    Respondent = apps.get_model('report', 'Respondent')
+    Answer = apps.get_model('report', 'Answer')
+    RespondentQuestion = Respondent.questions.through
+
+    merge = duplicates(Question, ['survey_id', 'sm_id'])
+    repoint(Choice, 'question_id', merge)
+    repoint(Answer, 'question_id', merge)
+    repoint_links(RespondentQuestion, 'question_id', 'respondent_id', merge)
+    Question.objects.filter(pk__in=list(merge)).delete()
+
+    merge = duplicates(Choice, ['question_id', 'sm_id'])
+    repoint(Answer, 'choice_id', merge)
+    Choice.objects.filter(pk__in=list(merge)).delete()
+
+    merge = duplicates(Respondent, ['survey_id', 'sm_id'])
+    repoint(Answer, 'respondent_id', merge)
+    repoint_links(RespondentQuestion, 'respondent_id', 'question_id', merge)
+    Respondent.objects.filter(pk__in=list(merge)).delete()
+
+    # Merged rows can leave the same answer twice
+    merge = duplicates(Answer, ['question_id', 'respondent_id', 'choice_id', 'text'])
+    Answer.objects.filter(pk__in=list(merge)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0013_survey_report_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
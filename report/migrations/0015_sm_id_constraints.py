@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0014_merge_duplicate_sm_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='choice',
+            name='weight',
+            field=models.IntegerField(null=True, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='choice',
+            unique_together=set([('question', 'sm_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='question',
+            unique_together=set([('survey', 'sm_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='respondent',
+            unique_together=set([('survey', 'sm_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('question', 'choice', 'respondent')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0015_sm_id_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NpsBucket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('respondents', models.IntegerField(default=0)),
+                ('promoters', models.IntegerField(default=0)),
+                ('passives', models.IntegerField(default=0)),
+                ('detractors', models.IntegerField(default=0)),
+                ('survey', models.ForeignKey(related_name='nps_buckets', to='report.Survey')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='respondent',
+            name='submitted',
+            field=models.DateTimeField(null=True, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='npsbucket',
+            unique_together=set([('survey', 'day')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0016_nps_trend'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='survey',
+            name='last_response_modified',
+            field=models.DateTimeField(null=True, editable=False),
+        ),
+    ]
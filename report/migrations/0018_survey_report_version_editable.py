@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0017_survey_last_response_modified_editable'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='survey',
+            name='report_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
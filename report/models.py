@@ -1,8 +1,44 @@
 from __future__ import division
 import os
-from django.db import models
-from sm_api import SurveyMonkeyClient
-from report.helpers import str_truncate
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta, time
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, When, Sum, Count, IntegerField, F, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from sm_api import SurveyMonkeyClient, shared_rate_limiter
+from report.helpers import str_truncate, rounded_percentage, nps_score, period_start
+
+# Choice weights for each Net Promoter Score group
+# See https://www.netpromoter.com/know/
+NPS_PROMOTER_WEIGHTS = [9, 10]
+NPS_PASSIVE_WEIGHTS = [7, 8]
+NPS_DETRACTOR_WEIGHTS = range(0, 7)
+
+# Periods Survey.nps_trend() can group daily NPS buckets by
+NPS_TREND_PERIODS = ("day", "week", "month")
+
+
+def _count_weights(weights):
+    '''
+    Aggregate expression counting answers whose choice
+    weight is in weights, for use in annotate()/aggregate()
+    '''
+    return Sum(Case(
+        When(choice__weight__in=weights, then=1),
+        default=0,
+        output_field=IntegerField(),
+    ))
+
+
+def _proportion(numer, denom):
+    if denom == 0:
+        return 0
+    else:
+        return numer / denom
 
 
 class Survey(models.Model):
@@ -14,6 +50,12 @@ class Survey(models.Model):
     last_updated = models.DateTimeField(auto_now=True)
     # Error message generated during API calls
     error_message = models.CharField(max_length=255, null=True, default=None)
+    # Latest respondent modification date seen by download_responses()
+    # Incremental syncs only fetch respondents modified since then
+    last_response_modified = models.DateTimeField(null=True, editable=False)
+    # Bumped whenever synced data changes, so cached reports
+    # keyed on it are never served stale
+    report_version = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ['last_updated', 'name']
@@ -21,15 +63,52 @@ class Survey(models.Model):
     def __unicode__(self):
         return self.name
 
+    def get_client(self):
+        '''
+        Returns a SurveyMonkeyClient using known credentials
+        and the concurrency, rate limits and transport configured
+        in settings, with sm_id already cached if we have it.
+        Every client of the process shares one rate limiter, so
+        the API quota holds across syncs
+        '''
+        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
+        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
+        transport = settings.SURVEYMONKEY_TRANSPORT
+        client = SurveyMonkeyClient(
+            SURVEYMONKEY_API_TOKEN,
+            SURVEYMONKEY_API_KEY,
+            max_workers=settings.SURVEYMONKEY_MAX_WORKERS,
+            max_in_flight=settings.SURVEYMONKEY_MAX_IN_FLIGHT,
+            transport_adapter=import_string(transport)() if transport else None,
+            rate_limiter=shared_rate_limiter(
+                SURVEYMONKEY_API_KEY,
+                settings.SURVEYMONKEY_REQUESTS_PER_SECOND,
+                settings.SURVEYMONKEY_REQUESTS_PER_DAY,
+            ),
+        )
+        # Skip the survey name lookup once we know the ID
+        if self.sm_id:
+            client.remember_survey_id(self.name, self.sm_id)
+        return client
+
+    def _store_sm_id(self, client):
+        '''
+        Persist the survey ID resolved by client on first use
+        The lookup is cached on the client, so this makes no API call
+        '''
+        if not self.sm_id:
+            self.sm_id = client.get_survey_id(self.name)
+            Survey.objects.filter(pk=self.pk).update(sm_id=self.sm_id)
+
     def update_details(self):
         '''
         Connects to SurveyMonkey API using known credentials
         and create or update questions & choices in db based
         on details obtained from get_survey_details API call
+        (see report.ingest.sync_schema)
         '''
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
+        from report.ingest import sync_schema
+        client = self.get_client()
         try:
             pages = client.get_survey_details(self.name)
         except IndexError:
@@ -37,99 +116,283 @@ class Survey(models.Model):
         else:
             # Clear error_message
             self.error_message = None
-            for p in pages:
-                for q in p["questions"]:
-                    # Skip if it's descriptive text
-                    if q["type"]["subtype"] != "descriptive_text":
-                        qid = q["question_id"]
-                        question, created = Question.objects.get_or_create(sm_id=qid, survey_id=self.id)
-                        question.text = q["heading"]
-                        question.survey_id = self.id
-                        if q["type"]["family"] == u'open_ended':
-                            question.open_ended = True
-                        question.save()
-                        # Update question choices as well
-                        for a in q['answers']:
-                            # Skip if no content in text
-                            if a["text"]:
-                                cid = a["answer_id"]
-                                text = a["text"]
-                                weight = a.get("weight")
-                                # TODO Allow change of choice text without
-                                # creating a new choice when 
-                                choice, created = Choice.objects.get_or_create(
-                                    sm_id=cid,
-                                    text=text,
-                                    weight=weight,
-                                    question_id=question.id
-                                    )
-
-    def download_responses(self):
-        '''
-        Use get_responses() method in SurveyMonkeyClient to
-        retrieve a list of response dicts, then get_or_create
+            self._store_sm_id(client)
+            changed, nps_changed = sync_schema(self, pages)
+            if nps_changed:
+                # Reweighted NPS choices move every day's score
+                self.refresh_nps_trend()
+            self.refresh_stats(changed)
+
+    def download_responses(self, chunk_size=None, incremental=False):
+        '''
+        Use iter_responses() method in SurveyMonkeyClient to
+        retrieve response dicts, then bulk create
         Respondent and Answer associated with the survey
+        (see report.ingest.ingest_responses)
+
+        With incremental=True, only respondents created or modified
+        since last_response_modified are requested, and respondents
+        who edited their submission get their answers replaced.
+        Without a stored high-water mark this is a full download
 
         You should always call update_details() before download_responses()
         to avoid having non-existent Questions for survey that has never
         been updated previously
+
+        Returns a dict of ingestion stats, or None if the
+        survey could not be found
         '''
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
+        from report.ingest import ingest_responses, CHUNK_SIZE
+        client = self.get_client()
+        modified_since = None
+        if self.last_response_modified:
+            modified_since = self.last_response_modified.astimezone(timezone.utc).strftime(client.DATE_FORMAT)
         try:
-            data = client.get_responses(self.name)
+            # Responses are streamed batch by batch into ingest_responses
+            data = client.iter_responses(self.name, modified_since=modified_since if incremental else None)
         except IndexError:
             self.error_message = "Could not find survey in SurveyMonkey. Are you sure the survey name is correct?"
         else:
             self.error_message = None
-            for r in data:
-                rid = r["respondent_id"]
-                respondent, created = Respondent.objects.get_or_create(sm_id=rid, survey_id=self.id)
-                # Only update Answer/Comment/Rating if it's a new respondent
-                # TODO This means that if a respondent somehow update
-                # their answers after submission, the updated value will not be reflected
-                # unless we create a manual override here
-                if created:
-                    for q in r["questions"]:
-                        # In each dict q there are 2 keys: "answers", and "question_id"
-                        # First, use "question_id" to locate the question text
-                        qid = q["question_id"]
-                        question = self.question_set.get(sm_id=qid, survey_id=self.id)
-                        # Associate the question with the respondent if
-                        # the question is not in the set yet
-                        if not respondent.questions.filter(id=question.id).exists():
-                            respondent.questions.add(question)
-                        # Next, find the response for this question
-                        # q["answers"] is a list of dicts
-                        for raw_answer in q["answers"]:
-                            # Here's the tricky part, in the raw_answer dict
-                            # Sometimes results come with "col", "row", or "text"
-                            # If "text" exists, that's a dead giveaway that it's an open-ended question
-                            # We can save that as comment
-                            if "text" in raw_answer.keys():
-                                comment, created = Answer.objects.get_or_create(
-                                    question_id=question.id,
-                                    respondent_id=respondent.id,
-                                    text=raw_answer["text"]
-                                    )
-                            else:
-                                # A quant response
-                                # There will be "row" and "col"
-                                # Use these to look up for responses
-                                row_id = raw_answer.get("row")
-                                col_id = raw_answer.get("col")
-                                # If col_ans exists, it's a horizontal question
-                                if col_id:
-                                    choice = question.choice_set.get(sm_id=col_id)
-                                else:
-                                    # Try looking up with row_id
-                                    choice = question.choice_set.get(sm_id=row_id)
-                                rating, created = Answer.objects.get_or_create(
-                                    question_id=question.id,
-                                    choice_id=choice.id,
-                                    respondent_id=respondent.id,
-                                    )
+            self._store_sm_id(client)
+            self._nps_breakdown_cache = None
+            stats = ingest_responses(
+                self, data, chunk_size=chunk_size or CHUNK_SIZE, modified_since=modified_since)
+            self.refresh_nps_trend(stats["days"])
+            self.apply_stats_deltas(stats["deltas"])
+            if stats["last_modified"]:
+                last_modified = datetime.strptime(stats["last_modified"], client.DATE_FORMAT)
+                last_modified = timezone.make_aware(last_modified, timezone.utc)
+                if not self.last_response_modified or last_modified > self.last_response_modified:
+                    self.last_response_modified = last_modified
+                    Survey.objects.filter(pk=self.pk).update(last_response_modified=last_modified)
+            return stats
+
+    def sync(self, incremental=True):
+        '''
+        Refresh questions & choices, then responses, and save the
+        survey (error_message, last_updated). Used by SyncJob
+
+        Returns ingestion stats, or None if the survey could not be found
+        '''
+        stats = None
+        self.update_details()
+        if not self.error_message:
+            stats = self.download_responses(incremental=incremental)
+        # Everything else was written with update() along the way;
+        # saving all columns would undo admin edits made meanwhile
+        self.save(update_fields=["error_message", "last_updated"])
+        return stats
+
+    def refresh_stats(self, question_ids=None):
+        '''
+        Rebuild the SurveyStats rollup and the QuestionStats/ChoiceStats
+        rows for the given question ids (all questions if None), so
+        report views never have to count raw Answer rows.
+        Called at the end of update_details() with only the
+        questions it changed; downloads move the rollups with
+        apply_stats_deltas() instead. Questions or choices
+        without rollup rows yet (e.g., data from before the rollups
+        existed) are always rebuilt too. Also bumps report_version
+        '''
+        questions = self.question_set.order_by()
+        if question_ids is not None:
+            questions = questions.filter(
+                Q(id__in=question_ids) | Q(stats__isnull=True) | Q(choice__stats__isnull=True, choice__isnull=False))
+        question_ids = list(questions.values_list("id", flat=True).distinct())
+        choices = Choice.objects.filter(question_id__in=question_ids).values_list("id", "question_id")
+        # Respondents per question, as in question.respondent_set.count()
+        respondents = dict(
+            Respondent.questions.through.objects.filter(question_id__in=question_ids)
+            .values_list("question_id").annotate(n=Count("id")).order_by()
+        )
+        # Answers per question and per choice, in one grouped query
+        answers = {}
+        choice_answers = {}
+        for question_id, choice_id, n in (
+                Answer.objects.filter(question_id__in=question_ids)
+                .values_list("question_id", "choice_id").annotate(n=Count("id")).order_by()):
+            answers[question_id] = answers.get(question_id, 0) + n
+            if choice_id is not None:
+                choice_answers[choice_id] = n
+        with transaction.atomic():
+            QuestionStats.objects.filter(question_id__in=question_ids).delete()
+            ChoiceStats.objects.filter(choice__question_id__in=question_ids).delete()
+            QuestionStats.objects.bulk_create([
+                QuestionStats(
+                    question_id=question_id,
+                    survey_id=self.id,
+                    respondent_count=respondents.get(question_id, 0),
+                    answer_count=answers.get(question_id, 0),
+                )
+                for question_id in question_ids
+            ])
+            ChoiceStats.objects.bulk_create([
+                ChoiceStats(
+                    choice_id=choice_id,
+                    survey_id=self.id,
+                    answer_count=choice_answers.get(choice_id, 0),
+                    raw_percentage=_proportion(choice_answers.get(choice_id, 0), respondents.get(question_id, 0)),
+                )
+                for choice_id, question_id in choices
+            ])
+            self._nps_breakdown_cache = None
+            totals = self._nps_totals() or {}
+            SurveyStats.objects.update_or_create(survey_id=self.id, defaults={
+                "respondent_count": self.respondent_set.count(),
+                "question_count": self.question_set.count(),
+                "nps_respondents": totals.get("respondents"),
+                "nps_promoters": totals.get("promoters"),
+                "nps_passives": totals.get("passives"),
+                "nps_detractors": totals.get("detractors"),
+            })
+            self.bump_report_version()
+
+    def apply_stats_deltas(self, deltas):
+        '''
+        Move the rollups by the rows ingest_responses() added and
+        removed (its "deltas") with F() updates, grouped by delta,
+        so a sync costs queries per question and choice it touched
+        rather than a recount of every Answer of the survey.
+        Questions or choices without rollup rows yet, or a survey
+        without SurveyStats, get refresh_stats() instead, which
+        recounts the survey-wide figures. Also bumps report_version
+        '''
+        from report.ingest import _bulk_update, CHUNK_SIZE
+        question_ids = set(
+            question_id for counter in (deltas["links"], deltas["answers"], deltas["answered"])
+            for question_id, n in counter.items() if n)
+        choice_ids = set(choice_id for choice_id, n in deltas["choices"].items() if n)
+        missing = set(self.question_set.filter(
+            Q(stats__isnull=True) | Q(choice__stats__isnull=True, choice__isnull=False)
+        ).order_by().values_list("id", flat=True).distinct())
+        with transaction.atomic():
+            groups = {}
+            for question_id in question_ids - missing:
+                key = (deltas["links"][question_id], deltas["answers"][question_id])
+                groups.setdefault(key, []).append(question_id)
+            for (links, answers), ids in groups.items():
+                QuestionStats.objects.filter(question_id__in=ids).update(
+                    respondent_count=F("respondent_count") + links, answer_count=F("answer_count") + answers)
+            groups = {}
+            for choice_id in choice_ids:
+                groups.setdefault(deltas["choices"][choice_id], []).append(choice_id)
+            for answers, ids in groups.items():
+                ChoiceStats.objects.filter(choice_id__in=ids).exclude(choice__question_id__in=missing).update(
+                    answer_count=F("answer_count") + answers)
+            # raw_percentage of the choices whose count or question's
+            # respondent count moved
+            linked = [question_id for question_id, n in deltas["links"].items() if n]
+            percentages = [
+                ChoiceStats(id=stats_id, raw_percentage=_proportion(answers, respondents or 0))
+                for stats_id, answers, respondents in ChoiceStats.objects.filter(
+                    Q(choice_id__in=choice_ids) | Q(choice__question_id__in=linked)
+                ).exclude(choice__question_id__in=missing).values_list(
+                    "id", "answer_count", "choice__question__stats__respondent_count")
+            ]
+            _bulk_update(ChoiceStats, percentages, ["raw_percentage"], CHUNK_SIZE)
+
+            if missing or not SurveyStats.objects.filter(survey_id=self.id).exists():
+                self.refresh_stats(sorted(missing))
+                return
+            values = {"respondent_count": F("respondent_count") + deltas["respondents"], "refreshed": timezone.now()}
+            nps = dict.fromkeys(["respondents", "promoters", "passives", "detractors"], 0)
+            for question_id in self.question_set.filter(nps=True, id__in=question_ids).values_list("id", flat=True):
+                nps["respondents"] += deltas["answered"][question_id]
+            for choice_id, weight in Choice.objects.filter(
+                    id__in=choice_ids, question__nps=True).values_list("id", "weight"):
+                for key, weights in (("promoters", NPS_PROMOTER_WEIGHTS), ("passives", NPS_PASSIVE_WEIGHTS),
+                                     ("detractors", NPS_DETRACTOR_WEIGHTS)):
+                    if weight in weights:
+                        nps[key] += deltas["choices"][choice_id]
+            if any(nps.values()):
+                for key, n in nps.items():
+                    field = "nps_" + key
+                    # Null until the survey's first NPS answer
+                    values[field] = Coalesce(field, Value(0)) + n
+            SurveyStats.objects.filter(survey_id=self.id).update(**values)
+            self._nps_breakdown_cache = None
+            self.bump_report_version()
+
+    def refresh_nps_trend(self, days=None):
+        '''
+        Rebuild the NpsBucket rows of the given days (dates in the
+        local time zone, as returned by ingest_responses()), or of
+        every day if days is None
+
+        One grouped query tallies the NPS answers of each respondent
+        submitted in the span of days, as nps_breakdown() does per
+        question, and the tallies are summed per day here. After an
+        incremental sync only the few days with new or edited
+        responses are read again
+        '''
+        answers = Answer.objects.filter(
+            respondent__survey_id=self.id,
+            respondent__submitted__isnull=False,
+            question__nps=True,
+        )
+        buckets = self.nps_buckets.all()
+        if days is not None:
+            days = set(days)
+            if not days:
+                return
+            answers = answers.filter(
+                respondent__submitted__gte=timezone.make_aware(datetime.combine(min(days), time.min)),
+                respondent__submitted__lt=timezone.make_aware(datetime.combine(max(days) + timedelta(days=1), time.min)),
+            )
+            buckets = buckets.filter(day__in=days)
+        tallies = answers.order_by().values("respondent_id", "respondent__submitted").annotate(
+            promoters=_count_weights(NPS_PROMOTER_WEIGHTS),
+            passives=_count_weights(NPS_PASSIVE_WEIGHTS),
+            detractors=_count_weights(NPS_DETRACTOR_WEIGHTS),
+            respondents=Count("question_id", distinct=True),
+        )
+        counts = {}
+        for tally in tallies:
+            day = timezone.localtime(tally["respondent__submitted"]).date()
+            if days is not None and day not in days:
+                continue
+            bucket = counts.setdefault(day, NpsBucket(survey_id=self.id, day=day))
+            bucket.promoters += tally["promoters"]
+            bucket.passives += tally["passives"]
+            bucket.detractors += tally["detractors"]
+            bucket.respondents += tally["respondents"]
+        with transaction.atomic():
+            buckets.delete()
+            NpsBucket.objects.bulk_create(counts.values())
+
+    def nps_trend(self, period="day"):
+        '''
+        Net Promoter Score over time from the daily NpsBucket rows,
+        one dict per day, week (starting Monday) or month with
+        responses, oldest first, e.g.,
+            [{"start": date(2015, 11, 23), "score": 29, "respondents": 7,
+              "promoters": 4, "passives": 1, "detractors": 2}]
+        '''
+        totals = OrderedDict()
+        for bucket in self.nps_buckets.order_by("day"):
+            start = period_start(bucket.day, period)
+            entry = totals.setdefault(start, dict.fromkeys(["respondents", "promoters", "passives", "detractors"], 0))
+            entry["respondents"] += bucket.respondents
+            entry["promoters"] += bucket.promoters
+            entry["passives"] += bucket.passives
+            entry["detractors"] += bucket.detractors
+        trend = []
+        for start, entry in totals.items():
+            entry["start"] = start
+            entry["score"] = nps_score(entry["promoters"], entry["detractors"], entry["respondents"])
+            trend.append(entry)
+        return trend
+
+    def bump_report_version(self):
+        '''
+        Invalidate cached renderings of this survey's report
+        and move last_updated, which conditional GETs rely on
+        '''
+        now = timezone.now()
+        Survey.objects.filter(pk=self.pk).update(report_version=F("report_version") + 1, last_updated=now)
+        self.report_version += 1
+        self.last_updated = now
 
     def respondent_count(self):
         return self.respondent_set.count()
@@ -141,59 +404,84 @@ class Survey(models.Model):
         return self.question_set.filter(nps=True)
     nps_questions = property(_nps_questions)
 
+    def nps_breakdown(self):
+        '''
+        Counts promoters, passives, detractors and respondents for
+        every NPS question of the survey in one grouped query, using
+        conditional aggregation on Choice.weight, and returns
+        a dict keyed by question id, e.g.,
+            {12: {"promoters": 4, "passives": 1, "detractors": 2, "respondents": 7}}
+
+        Respondents are the distinct respondents with an answer to
+        the question, which is what Respondent.questions links to.
+        The result is memoized on the instance so all the NPS
+        properties below share a single query
+        '''
+        if self._nps_breakdown_cache is None:
+            rows = Answer.objects.filter(
+                question__survey_id=self.id,
+                question__nps=True,
+            ).order_by().values("question_id").annotate(
+                promoters=_count_weights(NPS_PROMOTER_WEIGHTS),
+                passives=_count_weights(NPS_PASSIVE_WEIGHTS),
+                detractors=_count_weights(NPS_DETRACTOR_WEIGHTS),
+                respondents=Count("respondent_id", distinct=True),
+            )
+            self._nps_breakdown_cache = dict((row.pop("question_id"), row) for row in rows)
+        return self._nps_breakdown_cache
+    _nps_breakdown_cache = None
+
+    def _nps_totals(self):
+        '''
+        Sum nps_breakdown() across all versions of NPS questions
+        Returns None if no NPS question has been answered
+        '''
+        breakdown = self.nps_breakdown()
+        if breakdown:
+            totals = dict.fromkeys(["promoters", "passives", "detractors", "respondents"], 0)
+            for counts in breakdown.values():
+                for key in totals:
+                    totals[key] += counts[key]
+            return totals
+
+    def _nps_prop(self, key):
+        totals = self._nps_totals()
+        if totals:
+            return rounded_percentage(totals[key], totals["respondents"])
+
     def _nps_respondent_count(self):
-        if self.nps_questions:
-            count_all_respondents = 0
-            for q in self.nps_questions:
-                count_all_respondents += q.respondent_set.count()
-            return count_all_respondents
+        totals = self._nps_totals()
+        if totals:
+            return totals["respondents"]
 
     def _promoters_count(self):
-        if self.nps_questions:
-            count_all_promoters = 0
-            for q in self.nps_questions:
-                count_all_promoters += q.promoters_count
-            return count_all_promoters
+        totals = self._nps_totals()
+        if totals:
+            return totals["promoters"]
     promoters_count = property(_promoters_count)
 
     def _promoters_prop(self):
-        if self.nps_questions:
-            count_all_promoters = self._promoters_count()
-            count_all_respondents = self._nps_respondent_count()
-            prop = count_all_promoters / count_all_respondents
-            return int(round(prop * 100))
+        return self._nps_prop("promoters")
     promoters_prop = property(_promoters_prop)
 
     def _passives_count(self):
-        if self.nps_questions:
-            count_all_passives = 0
-            for q in self.nps_questions:
-                count_all_passives += q.passives_count
-            return count_all_passives
+        totals = self._nps_totals()
+        if totals:
+            return totals["passives"]
     passives_count = property(_passives_count)
 
     def _passives_prop(self):
-        if self.nps_questions:
-            count_all_passives = self._passives_count()
-            count_all_respondents = self._nps_respondent_count()
-            prop = count_all_passives / count_all_respondents
-            return int(round(prop * 100))
+        return self._nps_prop("passives")
     passives_prop = property(_passives_prop)
 
     def _detractors_count(self):
-        if self.nps_questions:
-            count_all_detractors = 0
-            for q in self.nps_questions:
-                count_all_detractors += q.detractors_count
-            return count_all_detractors
+        totals = self._nps_totals()
+        if totals:
+            return totals["detractors"]
     detractors_count = property(_detractors_count)
 
     def _detractors_prop(self):
-        if self.nps_questions:
-            count_all_detractors = self._detractors_count()
-            count_all_respondents = self._nps_respondent_count()
-            prop = count_all_detractors / count_all_respondents
-            return int(round(prop * 100))
+        return self._nps_prop("detractors")
     detractors_prop = property(_detractors_prop)
 
     def _net_promoter_score(self):
@@ -207,21 +495,11 @@ class Survey(models.Model):
         - Calculate detractors %
         - Subtract detractors % from promoters % to arrive at NPS
         See calculation method here: https://www.netpromoter.com/know/
+        The tallies come from nps_breakdown(), a single query
         '''
-        if self.nps_questions:
-            count_all_promoters = 0
-            count_all_detractors = 0
-            count_all_respondents = 0
-            for q in self.nps_questions:
-                count_all_promoters += q.promoters_count
-                count_all_detractors += q.detractors_count
-                count_all_respondents += q.respondent_set.count()
-            promoters_prop = count_all_promoters / count_all_respondents
-            detractors_prop = count_all_detractors / count_all_respondents
-            raw_score = promoters_prop - detractors_prop
-            # Need to multiply by 100 and round up
-            score = round(raw_score * 100)
-            return int(score)
+        totals = self._nps_totals()
+        if totals:
+            return nps_score(totals["promoters"], totals["detractors"], totals["respondents"])
     net_promoter_score = property(_net_promoter_score)
 
 
@@ -236,6 +514,8 @@ class Question(models.Model):
 
     class Meta:
         ordering = ['survey', 'text']
+        # Ingestion matches questions on sm_id within a survey
+        unique_together = [('survey', 'sm_id')]
 
     def __unicode__(self):
         return str_truncate(self.text)
@@ -255,8 +535,7 @@ class Question(models.Model):
         It'll return the count of promoters (those rating 9-10)
         '''
         if self.nps:
-            values_range = [9, 10]
-            return self._helper_count_responses(values_range)
+            return self._helper_count_responses(NPS_PROMOTER_WEIGHTS)
     promoters_count = property(_nps_promoters_count)
 
     def _nps_detractors_count(self):
@@ -265,8 +544,7 @@ class Question(models.Model):
         It'll return the count of detractors (those rating 0-6)
         '''
         if self.nps:
-            values_range = range(0, 7)
-            return self._helper_count_responses(values_range)
+            return self._helper_count_responses(NPS_DETRACTOR_WEIGHTS)
     detractors_count = property(_nps_detractors_count)
 
     def _nps_passives_count(self):
@@ -275,17 +553,20 @@ class Question(models.Model):
         It'll return the count of passives (those rating 7-8)
         '''
         if self.nps:
-            values_range = [7, 8]
-            return self._helper_count_responses(values_range)
+            return self._helper_count_responses(NPS_PASSIVE_WEIGHTS)
     passives_count = property(_nps_passives_count)
 
 
 class Choice(models.Model):
     sm_id = models.CharField("SurveyMonkey ID", max_length=50)
     text = models.CharField(max_length=255)
-    weight = models.IntegerField(null=True)
+    # Indexed for the NPS weight filters
+    weight = models.IntegerField(null=True, db_index=True)
     question = models.ForeignKey(Question)
 
+    class Meta:
+        unique_together = [('question', 'sm_id')]
+
     def __unicode__(self):
         return "{choice} - {qn}".format(choice=self.text, qn=str_truncate(self.question.text))
 
@@ -297,10 +578,7 @@ class Choice(models.Model):
         '''
         numer = self.answer_set.count()
         denom = self.question.respondent_set.count()
-        if denom == 0:
-            return 0
-        else:
-            return numer / denom
+        return _proportion(numer, denom)
     raw_percentage = property(_get_raw_percentage)
 
 
@@ -308,6 +586,13 @@ class Respondent(models.Model):
     sm_id = models.CharField("SurveyMonkey ID", max_length=50)
     survey = models.ForeignKey(Survey)
     questions = models.ManyToManyField(Question)
+    # When the response was submitted: its date_modified when first
+    # downloaded. Edits replace its answers but keep it on this
+    # date, so it stays in the same NpsBucket
+    submitted = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        unique_together = [('survey', 'sm_id')]
 
     def __unicode__(self):
         return "ID {}".format(self.sm_id)
@@ -321,6 +606,12 @@ class Answer(models.Model):
     # Input for open-ended
     text = models.TextField(null=True)
 
+    class Meta:
+        # Per-choice counts and respondent lookups read this index
+        # alone. Not unique: text answers have no choice, and NULLs
+        # never collide in a unique index
+        index_together = [('question', 'choice', 'respondent')]
+
     def __unicode__(self):
         q = str_truncate(self.question.text)
         if self.text:
@@ -330,3 +621,182 @@ class Answer(models.Model):
             a = str_truncate(self.choice.text)
             string = '{a} - {q}'
         return string.format(a=a, q=q)
+
+
+class SurveyStats(models.Model):
+    '''
+    Rollup of survey-wide figures shown on the report pages
+    Rebuilt by Survey.refresh_stats() whenever data is synced
+    '''
+    survey = models.OneToOneField(Survey, related_name="stats")
+    respondent_count = models.IntegerField(default=0)
+    question_count = models.IntegerField(default=0)
+    # Net Promoter Score breakdown, null if the survey has no NPS answers
+    nps_respondents = models.IntegerField(null=True)
+    nps_promoters = models.IntegerField(null=True)
+    nps_passives = models.IntegerField(null=True)
+    nps_detractors = models.IntegerField(null=True)
+    refreshed = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"Stats for {}".format(self.survey)
+
+    def _promoters_prop(self):
+        return rounded_percentage(self.nps_promoters, self.nps_respondents)
+    promoters_prop = property(_promoters_prop)
+
+    def _passives_prop(self):
+        return rounded_percentage(self.nps_passives, self.nps_respondents)
+    passives_prop = property(_passives_prop)
+
+    def _detractors_prop(self):
+        return rounded_percentage(self.nps_detractors, self.nps_respondents)
+    detractors_prop = property(_detractors_prop)
+
+    def _net_promoter_score(self):
+        return nps_score(self.nps_promoters, self.nps_detractors, self.nps_respondents)
+    net_promoter_score = property(_net_promoter_score)
+
+
+class QuestionStats(models.Model):
+    '''
+    Rollup of per-question counts, see Survey.refresh_stats()
+    survey is denormalized so a report can load all rows at once
+    '''
+    question = models.OneToOneField(Question, related_name="stats")
+    survey = models.ForeignKey(Survey)
+    respondent_count = models.IntegerField(default=0)
+    answer_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u"Stats for {}".format(self.question)
+
+
+class ChoiceStats(models.Model):
+    '''
+    Rollup of per-choice counts, see Survey.refresh_stats()
+    raw_percentage has the same meaning as Choice.raw_percentage
+    '''
+    choice = models.OneToOneField(Choice, related_name="stats")
+    survey = models.ForeignKey(Survey)
+    answer_count = models.IntegerField(default=0)
+    raw_percentage = models.FloatField(default=0)
+
+    def __unicode__(self):
+        return u"Stats for {}".format(self.choice)
+
+
+class NpsBucket(models.Model):
+    '''
+    Net Promoter Score tallies of the respondents submitted on
+    one day (local time zone), summed by Survey.nps_trend()
+    Rebuilt per day by Survey.refresh_nps_trend() after each sync
+    '''
+    survey = models.ForeignKey(Survey, related_name="nps_buckets")
+    day = models.DateField()
+    respondents = models.IntegerField(default=0)
+    promoters = models.IntegerField(default=0)
+    passives = models.IntegerField(default=0)
+    detractors = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("survey", "day")]
+
+    def __unicode__(self):
+        return u"NPS of {survey} on {day}".format(survey=self.survey, day=self.day)
+
+    def _net_promoter_score(self):
+        return nps_score(self.promoters, self.detractors, self.respondents)
+    net_promoter_score = property(_net_promoter_score)
+
+
+class SyncJob(models.Model):
+    '''
+    Queued refresh of one survey, run by a worker process
+    (manage.py sync_surveys --worker) instead of a web request
+    '''
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+    survey = models.ForeignKey(Survey)
+    incremental = models.BooleanField(default=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    error_message = models.TextField(null=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return u"{survey} ({status})".format(survey=self.survey, status=self.status)
+
+    def _duration(self):
+        '''
+        Seconds the job took to run, None until it has finished
+        '''
+        if self.started and self.finished:
+            return (self.finished - self.started).total_seconds()
+    duration = property(_duration)
+
+    @classmethod
+    def enqueue(cls, survey, incremental=True):
+        '''
+        Queue a sync for survey, reusing a job that is already
+        waiting for it rather than piling up duplicates
+        '''
+        job = cls.objects.filter(survey=survey, status=cls.QUEUED).first()
+        if job is None:
+            job = cls.objects.create(survey=survey, incremental=incremental)
+        elif job.incremental and not incremental:
+            job.incremental = False
+            job.save(update_fields=["incremental"])
+        return job
+
+    @classmethod
+    def claim_next(cls):
+        '''
+        Mark the oldest queued job whose survey is not already being
+        synced as running and return it, or None if there is none.
+        The survey row is locked while checking, so two workers can
+        never start a job for the same survey. Running jobs older
+        than SYNC_JOB_TIMEOUT seconds are treated as abandoned
+        '''
+        now = timezone.now()
+        stale = now - timedelta(seconds=settings.SYNC_JOB_TIMEOUT)
+        candidates = cls.objects.filter(status=cls.QUEUED).values_list("id", "survey_id")[:20]
+        for job_id, survey_id in candidates:
+            with transaction.atomic():
+                list(Survey.objects.select_for_update().filter(pk=survey_id))
+                busy = cls.objects.filter(survey_id=survey_id, status=cls.RUNNING, started__gt=stale).exists()
+                if busy:
+                    continue
+                claimed = cls.objects.filter(pk=job_id, status=cls.QUEUED).update(status=cls.RUNNING, started=now)
+            if claimed:
+                return cls.objects.select_related("survey").get(pk=job_id)
+
+    def run(self):
+        '''
+        Sync the survey and record the outcome on the job
+        '''
+        try:
+            self.survey.sync(incremental=self.incremental)
+        except Exception:
+            self.status = self.FAILED
+            self.error_message = traceback.format_exc()
+        else:
+            if self.survey.error_message:
+                self.status = self.FAILED
+                self.error_message = self.survey.error_message
+            else:
+                self.status = self.DONE
+        self.finished = timezone.now()
+        self.save()
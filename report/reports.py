@@ -0,0 +1,349 @@
+from __future__ import division
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from report.helpers import rounded_percentage, nps_score
+from report.intervals import wilson_interval, nps_interval, bootstrap_proportions, bootstrap_nps
+from report.models import Choice, Answer
+
+# Parts of build_report(): top-level blocks, plus "comments",
+# the first page of comments within each open-ended question
+REPORT_FIELDS = ("survey", "nps", "questions", "comments")
+
+
+def build_report(survey, fields=REPORT_FIELDS, segment=None):
+    '''
+    Gather everything the survey report shows into plain
+    dicts and lists, read from the stats rollups in a number
+    of queries that does not depend on how many questions,
+    choices or answers the survey has:
+        {
+            "survey": {"id": 1, "name": u'...', "last_updated": datetime, "version": 7},
+            "nps": {"score": 17, "promoters": 3, "promoters_prop": 50, ...},
+            "questions": [
+                {"id": 1, "text": u'...', "open_ended": False, "nps": True,
+                 "respondent_count": 6, "answer_count": 6,
+                 "choices": [{"id": 1, "text": u'...', "weight": 9,
+                              "answer_count": 2, "raw_percentage": 0.33}],
+                 "comments": [], "comments_next": None},
+            ],
+        }
+    Open-ended questions carry their first page of comments
+    (one query for all of them, see first_comment_pages()) and the
+    cursor for the next.
+    Select survey.stats with the survey to save one more query
+
+    fields picks which of REPORT_FIELDS to build, e.g., ("nps",)
+    needs no queries beyond the survey and its stats, and without
+    "comments" the report takes three queries however many
+    open-ended questions there are
+
+    With a report.segments.Segment, NPS and counts cover the
+    segment's respondents only. They are then read from the
+    survey's cached ResponseMatrix instead of the rollups, in
+    the same number of queries, and a "segment" block says who
+    was counted:
+        "segment": {"match": "all", "respondents": 2,
+                    "conditions": [{"question_id": 1, "choice_ids": [3],
+                                    "question": u'...', "choices": [u'...']}]}
+    Raises SegmentError if the segment does not fit the survey
+
+    With REPORT_INTERVALS set, the NPS block gets the bounds of
+    its confidence interval ("score_low", "score_high" and the
+    "confidence" level) and every choice gets "low" and "high"
+    bounds for its raw_percentage, see add_intervals()
+    '''
+    counts = rows = None
+    if segment is not None:
+        from report.analytics import get_matrix
+        matrix = get_matrix(survey)
+        rows = segment.mask(matrix)
+        counts = _segment_counts(matrix, rows)
+
+    report = {}
+    if "survey" in fields:
+        report["survey"] = {
+            "id": survey.id,
+            "name": survey.name,
+            "last_updated": survey.last_updated,
+            "version": survey.report_version,
+        }
+    if "nps" in fields:
+        report["nps"] = build_nps(survey) if counts is None else _nps_figures(counts["nps"])
+    if "questions" in fields:
+        report["questions"] = build_questions(
+            survey, comments="comments" in fields, segment=segment, counts=counts)
+    if segment is not None:
+        report["segment"] = _describe_segment(segment, rows, report.get("questions"))
+    if settings.REPORT_INTERVALS:
+        add_intervals(report, settings.REPORT_INTERVALS, settings.REPORT_CONFIDENCE)
+    return report
+
+
+class LazyReport(object):
+    '''
+    build_report() one block at a time, built on first lookup,
+    for templates that may never read some blocks, e.g., with
+    REPORT_CACHE='fragment' a cached fragment skips its block:
+        {{ report.nps.score }}
+    '''
+    # build_report() fields each block is built from; the
+    # segment block only needs question and choice texts
+    BLOCK_FIELDS = {
+        "survey": ("survey",),
+        "nps": ("nps",),
+        "questions": ("questions", "comments"),
+        "segment": ("questions",),
+    }
+
+    def __init__(self, survey, segment=None):
+        self.survey = survey
+        self.segment = segment
+        self._blocks = {}
+
+    def __getitem__(self, name):
+        if name not in self._blocks:
+            # KeyError lets templates fall back to attributes
+            fields = self.BLOCK_FIELDS[name]
+            if name == "segment" and self.segment is None:
+                # No segment block to build
+                fields = ()
+            self._blocks[name] = build_report(self.survey, fields, segment=self.segment).get(name)
+        return self._blocks[name]
+
+
+def add_intervals(report, method="analytic", confidence=0.95):
+    '''
+    Add margins of error to the "nps" and "questions" blocks of
+    a report in place, by the analytic method (normal
+    approximation for NPS, Wilson score for proportions) or by
+    "bootstrap". The choices of all questions are computed in
+    one go over arrays of counts. Bounds are None where there
+    is nothing to estimate from
+    '''
+    bootstrap = method == "bootstrap"
+    nps = report.get("nps")
+    if nps and nps["respondents"]:
+        interval = bootstrap_nps if bootstrap else nps_interval
+        low, high = interval(nps["promoters"], nps["detractors"], nps["respondents"], confidence)
+        nps.update(score_low=int(round(low)), score_high=int(round(high)), confidence=confidence)
+    choices = [(choice, question["respondent_count"])
+               for question in report.get("questions", []) for choice in question["choices"]]
+    if choices:
+        interval = bootstrap_proportions if bootstrap else wilson_interval
+        low, high = interval(
+            np.array([choice["answer_count"] for choice, respondents in choices], dtype=np.int64),
+            np.array([respondents for choice, respondents in choices], dtype=np.int64),
+            confidence)
+        for (choice, respondents), choice_low, choice_high in zip(choices, low.tolist(), high.tolist()):
+            choice["low"] = None if respondents == 0 else choice_low
+            choice["high"] = None if respondents == 0 else choice_high
+
+
+def build_questions(survey, comments=True, segment=None, counts=None):
+    '''
+    The "questions" block of build_report(), with the first
+    page of comments unless comments is False. counts, from
+    _segment_counts(), replaces the stats rollups and segment
+    narrows the comments down to its respondents
+    '''
+    questions = []
+    by_id = {}
+    for question in survey.question_set.select_related('stats').order_by('text'):
+        stats = _stats(question) if counts is None else counts["questions"][question.id]
+        entry = {
+            "id": question.id,
+            "text": question.text,
+            "open_ended": question.open_ended,
+            "nps": question.nps,
+            "respondent_count": stats.respondent_count if stats else 0,
+            "answer_count": stats.answer_count if stats else 0,
+            "choices": [],
+        }
+        if comments:
+            entry.update(comments=[], comments_next=None)
+        questions.append(entry)
+        by_id[question.id] = entry
+
+    choices = Choice.objects.filter(question__survey_id=survey.id).select_related('stats').order_by('id')
+    for choice in choices:
+        stats = _stats(choice) if counts is None else counts["choices"][choice.id]
+        by_id[choice.question_id]["choices"].append({
+            "id": choice.id,
+            "text": choice.text,
+            "weight": choice.weight,
+            "answer_count": stats.answer_count if stats else 0,
+            "raw_percentage": stats.raw_percentage if stats else 0,
+        })
+
+    # Only the first page of each comment board ships with the
+    # report, the rest is fetched by the page as the reader scrolls
+    if comments:
+        open_ended = [entry["id"] for entry in questions if entry["open_ended"]]
+        for question_id, page in first_comment_pages(open_ended, segment=segment).items():
+            by_id[question_id]["comments"], by_id[question_id]["comments_next"] = page
+
+    return questions
+
+
+def first_comment_pages(question_ids, limit=None, segment=None):
+    '''
+    The first comment_page() of each of question_ids, as a dict
+    of question id to (comments, next cursor), in one query that
+    numbers each question's comments with row_number() and keeps
+    the first limit + 1. Databases without window functions
+    (SQLite before 3.25, MySQL before 8) get one query per question
+    '''
+    limit = limit or settings.COMMENTS_PAGE_SIZE
+    if not question_ids:
+        return {}
+    if not _window_functions(connection):
+        return {question_id: comment_page(question_id, limit=limit, segment=segment)
+                for question_id in question_ids}
+    answers = Answer.objects.filter(question_id__in=question_ids, text__isnull=False)
+    if segment is not None:
+        answers = answers.filter(segment.answer_filter())
+    sql, params = answers.order_by().values_list('id', 'question_id', 'text').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, question_id, text FROM ("
+            " SELECT id, question_id, text,"
+            " row_number() OVER (PARTITION BY question_id ORDER BY id) AS position"
+            " FROM ({}) answers) ranked "
+            "WHERE position <= %s ORDER BY question_id, id".format(sql),
+            params + (limit + 1,))
+        rows = cursor.fetchall()
+    pages = {question_id: ([], None) for question_id in question_ids}
+    for answer_id, question_id, text in rows:
+        page, next_cursor = pages[question_id]
+        # The extra row only says that another page exists
+        if len(page) < limit:
+            page.append({"id": answer_id, "text": text})
+        else:
+            pages[question_id] = page, page[-1]["id"]
+    return pages
+
+
+def _window_functions(connection):
+    '''
+    Whether the database behind connection has row_number() OVER
+    '''
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25)
+    if connection.vendor == 'mysql':
+        return connection.mysql_version >= (8,)
+    return True
+
+
+def comment_page(question_id, after=None, limit=None, segment=None):
+    '''
+    One page of comments for an open-ended question, keyed on
+    Answer.id: the limit comments following answer id after
+    (from the start if None), from segment's respondents only if
+    given. Returns a list of {"id", "text"} dicts and the cursor
+    for the next page, None on the last one
+    '''
+    limit = limit or settings.COMMENTS_PAGE_SIZE
+    answers = Answer.objects.filter(question_id=question_id, text__isnull=False)
+    if segment is not None:
+        answers = answers.filter(segment.answer_filter())
+    if after is not None:
+        answers = answers.filter(id__gt=after)
+    # Fetch one extra row to know whether another page exists
+    rows = list(answers.order_by('id').values_list('id', 'text')[:limit + 1])
+    comments = [{"id": answer_id, "text": text} for answer_id, text in rows[:limit]]
+    next_cursor = comments[-1]["id"] if len(rows) > limit else None
+    return comments, next_cursor
+
+
+def build_nps(survey):
+    '''
+    Net Promoter Score panel figures from survey.stats
+    All values are None if the survey has no NPS answers yet
+    '''
+    stats = _stats(survey)
+    return _nps_figures(stats and {
+        "respondents": stats.nps_respondents,
+        "promoters": stats.nps_promoters,
+        "passives": stats.nps_passives,
+        "detractors": stats.nps_detractors,
+    })
+
+
+def _nps_figures(totals):
+    '''
+    build_nps() figures from respondent, promoter, passive and
+    detractor totals, all None without totals
+    '''
+    if not totals:
+        totals = dict.fromkeys(["respondents", "promoters", "passives", "detractors"])
+    respondents = totals["respondents"]
+    figures = dict(totals, score=nps_score(totals["promoters"], totals["detractors"], respondents))
+    for key in ("promoters", "passives", "detractors"):
+        figures[key + "_prop"] = rounded_percentage(totals[key], respondents)
+    return figures
+
+
+class _Counts(object):
+    '''
+    Stand-in for QuestionStats/ChoiceStats in build_questions()
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _segment_counts(matrix, rows):
+    '''
+    Counts of a segment's respondents in the shape
+    build_questions() reads from the stats rollups
+    '''
+    question_respondents = matrix.question_respondents(rows).tolist()
+    questions = dict(
+        (question_id, _Counts(respondent_count=respondents, answer_count=answers))
+        for question_id, respondents, answers in zip(
+            matrix.question_ids.tolist(), question_respondents, matrix.question_answers(rows).tolist()))
+    choices = {}
+    for choice_id, column, answers in zip(
+            matrix.choice_ids.tolist(), matrix.choice_questions.tolist(), matrix.choice_counts(rows).tolist()):
+        # Same definition as Choice.raw_percentage
+        respondents = question_respondents[column]
+        choices[choice_id] = _Counts(answer_count=answers, raw_percentage=answers / respondents if respondents else 0)
+    return {"nps": matrix.nps_totals(rows), "questions": questions, "choices": choices}
+
+
+def _describe_segment(segment, rows, questions=None):
+    '''
+    The "segment" block of build_report(), with question and
+    choice texts when the questions block was built
+    '''
+    by_id = dict((question["id"], question) for question in questions or [])
+    conditions = []
+    for question_id, choice_ids in segment.conditions:
+        condition = {"question_id": question_id, "choice_ids": list(choice_ids)}
+        if question_id in by_id:
+            texts = dict((choice["id"], choice["text"]) for choice in by_id[question_id]["choices"])
+            condition.update(question=by_id[question_id]["text"], choices=[texts[c] for c in choice_ids])
+        conditions.append(condition)
+    return {"match": segment.match, "respondents": int(rows.sum()), "conditions": conditions}
+
+
+def report_cache_key(survey, *parts):
+    '''
+    Cache key for a rendering of survey's report, e.g.,
+        report:12:7:page
+    Including report_version means a sync invalidates every
+    cached page and fragment of the survey at once
+    '''
+    return u":".join([u"report", str(survey.pk), str(survey.report_version)] + [str(p) for p in parts])
+
+
+def _stats(obj):
+    '''
+    obj.stats, or None if its rollup has not been built yet
+    '''
+    try:
+        return obj.stats
+    except ObjectDoesNotExist:
+        return None
@@ -0,0 +1,119 @@
+import operator
+from functools import reduce
+import numpy as np
+from django.db.models import Q
+from django.utils.http import urlencode
+from report.models import Answer
+
+# Ways Segment conditions combine: "all" (AND) or "any" (OR)
+SEGMENT_MATCHES = ("all", "any")
+
+# Upper bound on the where parameters of one segment
+MAX_SEGMENT_CONDITIONS = 10
+
+
+class SegmentError(ValueError):
+    '''
+    A segment that is malformed or does not fit the survey
+    '''
+
+
+class Segment(object):
+    '''
+    The respondents of a survey picked by their answers, to
+    report on part of them only, e.g., NPS among first-time
+    clients. Each condition is a question id and choice ids,
+    met by respondents who picked any of those choices (one
+    choice for answer-equals, several for answer-in). match
+    "all" keeps respondents meeting every condition, "any"
+    those meeting at least one. In query strings:
+        ?where=12:40&where=15:51,52&match=any
+
+    mask() works on the per-choice respondent bitsets of the
+    survey's ResponseMatrix, so a segment costs a few bitwise
+    operations rather than joins over Answer
+    '''
+    def __init__(self, conditions, match="all"):
+        if match not in SEGMENT_MATCHES:
+            raise SegmentError("match must be one of {}".format(", ".join(SEGMENT_MATCHES)))
+        # Sorted so equal segments share cache keys and links
+        self.conditions = sorted(
+            (int(question_id), tuple(sorted(set(int(c) for c in choice_ids))))
+            for question_id, choice_ids in conditions)
+        self.match = match
+
+    @classmethod
+    def from_query(cls, query):
+        '''
+        Segment from a request's GET parameters, or None if there
+        is no where parameter. Raises SegmentError for malformed
+        parameters
+        '''
+        wheres = query.getlist("where")
+        if not wheres:
+            return None
+        if len(wheres) > MAX_SEGMENT_CONDITIONS:
+            raise SegmentError("At most {} where parameters are allowed".format(MAX_SEGMENT_CONDITIONS))
+        conditions = []
+        for where in wheres:
+            question_id, _, choice_ids = where.partition(":")
+            try:
+                conditions.append((int(question_id), [int(c) for c in choice_ids.split(",")]))
+            except ValueError:
+                raise SegmentError(
+                    "where must look like <question id>:<choice id>[,<choice id>...], not {!r}".format(where))
+        return cls(conditions, query.get("match") or "all")
+
+    def _get_key(self):
+        '''
+        Canonical form for cache keys, e.g., all/12=40/15=51,52
+        '''
+        return "/".join([self.match] + [
+            "{}={}".format(question_id, ",".join(str(c) for c in choice_ids))
+            for question_id, choice_ids in self.conditions])
+    key = property(_get_key)
+
+    def _get_querystring(self):
+        params = [("where", "{}:{}".format(question_id, ",".join(str(c) for c in choice_ids)))
+                  for question_id, choice_ids in self.conditions]
+        return urlencode(params + [("match", self.match)])
+    querystring = property(_get_querystring)
+
+    def mask(self, matrix):
+        '''
+        Boolean mask over matrix.respondent_ids of the respondents
+        in the segment, ORing the bitsets of each condition's
+        choices and then ANDing or ORing the conditions.
+        Raises SegmentError if a condition names choices that are
+        not the question's
+        '''
+        bits = None
+        for question_id, choice_ids in self.conditions:
+            try:
+                positions = matrix.choice_positions(choice_ids)
+            except KeyError:
+                positions = None
+            if positions is None or (matrix.question_ids[matrix.choice_questions[positions]] != question_id).any():
+                raise SegmentError("Choices {} are not choices of question {}".format(
+                    ",".join(str(c) for c in choice_ids), question_id))
+            picked = np.bitwise_or.reduce(matrix.bitsets[positions], axis=0)
+            if bits is None:
+                bits = picked
+            elif self.match == "all":
+                bits &= picked
+            else:
+                bits |= picked
+        return matrix.rows_of(bits)
+
+    def answer_filter(self):
+        '''
+        Q object keeping the Answer rows of respondents in the
+        segment, for the queries that still go to the database
+        (comment pages)
+        '''
+        filters = [
+            Q(respondent_id__in=Answer.objects.filter(question_id=question_id, choice_id__in=choice_ids)
+              .values("respondent_id"))
+            for question_id, choice_ids in self.conditions
+        ]
+        return reduce(operator.and_ if self.match == "all" else operator.or_, filters)
@@ -1,4 +1,7 @@
 from django import template
+from django.conf import settings
+from django.core.cache import cache
+from report.reports import report_cache_key
 
 register = template.Library()
 
@@ -7,3 +10,48 @@ def percentage(value):
     return '{0:.0%}'.format(value)
 
 register.filter('percentage', percentage)
+
+
+class ReportFragmentNode(template.Node):
+    def __init__(self, nodelist, survey, parts):
+        self.nodelist = nodelist
+        self.survey = survey
+        self.parts = parts
+
+    def render(self, context):
+        if settings.REPORT_CACHE != 'fragment':
+            return self.nodelist.render(context)
+        survey = self.survey.resolve(context)
+        parts = [part.resolve(context) for part in self.parts]
+        # Empty parts (e.g., no segment) leave the key unchanged
+        parts = [part for part in parts if part not in ('', None)]
+        key = report_cache_key(survey, 'fragment', *parts)
+        content = cache.get(key)
+        if content is None:
+            content = self.nodelist.render(context)
+            cache.set(key, content, settings.REPORT_CACHE_TIMEOUT)
+        return content
+
+
+def report_fragment(parser, token):
+    '''
+    Caches a block of a survey report when REPORT_CACHE is
+    'fragment', keyed on the survey's report_version, e.g.,
+        {% report_fragment survey "question" question.id segment.key %}
+        ...
+        {% endreport_fragment %}
+    Otherwise the block is rendered as usual
+    '''
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            "'report_fragment' takes a survey and at least one key part")
+    nodelist = parser.parse(('endreport_fragment',))
+    parser.delete_first_token()
+    return ReportFragmentNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        [parser.compile_filter(bit) for bit in bits[2:]],
+    )
+
+register.tag('report_fragment', report_fragment)
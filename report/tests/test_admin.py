@@ -0,0 +1,137 @@
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import utc
+from report.admin import EstimatedCountPaginator
+from report.models import Survey, Question, Respondent, Answer, SyncJob
+from report.tests.test_views import create_nps_survey
+
+
+class SurveyAdminTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.surveys = [create_nps_survey("Survey %d" % n, [10, 9, 0] * n) for n in range(1, 4)]
+        Survey.objects.create(name="Never synced")
+
+    def test_changelist(self):
+        url = reverse('admin:report_survey_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, '<td class="field-nps">33</td>', html=True)
+        # The changelist costs the same however many surveys it lists
+        for n in range(3):
+            create_nps_survey("Another survey %d" % n, [10])
+        with self.assertNumQueries(len(queries)):
+            self.client.get(url)
+        # Sorted by score, highest first
+        content = self.client.get(url, {"o": "-2"}).content.decode("utf-8")
+        self.assertLess(content.index("Another survey 0"), content.index("Survey 1"))
+
+    def test_queue_sync_action(self):
+        response = self.client.post(reverse('admin:report_survey_changelist'), {
+            "action": "queue_full_sync",
+            "_selected_action": [s.pk for s in self.surveys[:2]],
+        })
+        self.assertEqual(response.status_code, 302)
+        jobs = SyncJob.objects.order_by("survey_id")
+        self.assertEqual([job.survey_id for job in jobs], [s.pk for s in self.surveys[:2]])
+        self.assertTrue(all(job.status == SyncJob.QUEUED and not job.incremental for job in jobs))
+
+
+    def test_change_form(self):
+        survey = self.surveys[0]
+        Survey.objects.filter(pk=survey.pk).update(last_response_modified=datetime(2015, 11, 25, tzinfo=utc))
+        version = Survey.objects.get(pk=survey.pk).report_version
+        questions = list(survey.question_set.all())
+        data = {
+            "name": "Renamed",
+            "sm_id": "1234",
+            "error_message": "Rate limited",
+            "question_set-TOTAL_FORMS": len(questions),
+            "question_set-INITIAL_FORMS": len(questions),
+            "question_set-MIN_NUM_FORMS": 0,
+            "question_set-MAX_NUM_FORMS": 1000,
+        }
+        for n, question in enumerate(questions):
+            data.update({
+                "question_set-%d-id" % n: question.pk,
+                "question_set-%d-survey" % n: survey.pk,
+                "question_set-%d-sm_id" % n: question.sm_id,
+                "question_set-%d-text" % n: question.text,
+                "question_set-%d-nps" % n: "on",
+            })
+        response = self.client.post(reverse('admin:report_survey_change', args=[survey.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        survey = Survey.objects.get(pk=survey.pk)
+        self.assertEqual(survey.name, "Renamed")
+        # Sync bookkeeping is not the form's to clear
+        self.assertEqual(survey.last_response_modified, datetime(2015, 11, 25, tzinfo=utc))
+        # Moved on by the edit, not reset
+        self.assertGreater(survey.report_version, version)
+
+
+class QuestionAdminTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.survey = create_nps_survey("Survey", [10, 9, 0])
+        self.question = self.survey.question_set.get()
+        # As synced: SurveyMonkey does not say which question is NPS
+        Question.objects.filter(pk=self.question.pk).update(nps=False)
+        self.survey.refresh_stats()
+        self.url = reverse('admin:report_question_change', args=[self.question.pk])
+
+    def post(self, nps=True, weights=None):
+        choices = list(self.question.choice_set.order_by("id"))
+        data = {
+            "sm_id": self.question.sm_id,
+            "text": self.question.text,
+            "survey": self.survey.pk,
+            "choice_set-TOTAL_FORMS": len(choices),
+            "choice_set-INITIAL_FORMS": len(choices),
+            "choice_set-MIN_NUM_FORMS": 0,
+            "choice_set-MAX_NUM_FORMS": 1000,
+        }
+        if nps:
+            data["nps"] = "on"
+        for n, choice in enumerate(choices):
+            weight = (weights or {}).get(choice.weight, choice.weight)
+            data.update({
+                "choice_set-%d-id" % n: choice.pk,
+                "choice_set-%d-question" % n: self.question.pk,
+                "choice_set-%d-sm_id" % n: choice.sm_id,
+                "choice_set-%d-text" % n: choice.text,
+                "choice_set-%d-weight" % n: weight,
+            })
+        response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 302)
+        return Survey.objects.select_related("stats").get(pk=self.survey.pk)
+
+    def test_flag_nps_refreshes_report(self):
+        Respondent.objects.update(submitted=datetime(2015, 11, 25, 20, tzinfo=utc))
+        self.survey.refresh_nps_trend()
+        self.assertEqual(self.survey.nps_trend(), [])
+        version = self.survey.report_version
+        survey = self.post()
+        self.assertEqual(survey.stats.net_promoter_score, 33)
+        self.assertGreater(survey.report_version, version)
+        self.assertEqual([t["score"] for t in survey.nps_trend()], [33])
+
+    def test_weight_edit_refreshes_report(self):
+        self.post()
+        # The 10 was really a 0
+        survey = self.post(weights={10: 0})
+        self.assertEqual(survey.stats.net_promoter_score, -33)
+
+
+class EstimatedCountPaginatorTestCase(TestCase):
+    def test_exact_count_off_postgresql(self):
+        create_nps_survey("Survey", [10, 9, 0])
+        paginator = EstimatedCountPaginator(Answer.objects.order_by("id"), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 3)
+            self.assertEqual(paginator.num_pages, 2)
@@ -0,0 +1,78 @@
+from django.core.cache import cache
+from django.test import TestCase
+from report.analytics import ResponseMatrix, get_matrix
+from report.models import Question, Choice, Respondent, Answer, ChoiceStats
+from report.tests.test_views import create_nps_survey
+
+
+class ResponseMatrixTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = create_nps_survey("NPS survey", [10, 9, 9, 7, 6, 0])
+        self.nps = self.survey.question_set.get()
+        # A select-all question answered by the first four respondents,
+        # and a comment box
+        self.select_all = Question.objects.create(sm_id="q2", text="Select all", survey=self.survey)
+        self.options = [
+            Choice.objects.create(sm_id="o%d" % n, text="Option %d" % n, question=self.select_all)
+            for n in range(3)
+        ]
+        self.comment = Question.objects.create(sm_id="q3", text="Comment", survey=self.survey, open_ended=True)
+        picks = [[0, 1], [0], [1, 2], [0, 1, 2]]
+        for respondent, options in zip(Respondent.objects.order_by("id"), picks):
+            respondent.questions.add(self.select_all)
+            for n in options:
+                Answer.objects.create(question=self.select_all, respondent=respondent, choice=self.options[n])
+            respondent.questions.add(self.comment)
+            Answer.objects.create(question=self.comment, respondent=respondent, text="Hello")
+        self.survey.refresh_stats()
+
+    def test_counts_match_stats(self):
+        with self.assertNumQueries(6):
+            matrix = ResponseMatrix.load(self.survey)
+        self.assertEqual(matrix.shape, (6, 3))
+        counts = dict(zip(matrix.choice_ids, matrix.choice_counts()))
+        for stats in ChoiceStats.objects.all():
+            self.assertEqual(counts[stats.choice_id], stats.answer_count)
+        respondents = dict(zip(matrix.question_ids, matrix.question_respondents()))
+        self.assertEqual(respondents, {self.nps.id: 6, self.select_all.id: 4, self.comment.id: 4})
+        self.assertEqual(matrix.nps_totals(), self.survey._nps_totals())
+        answers = dict(zip(matrix.question_ids, matrix.question_answers()))
+        self.assertEqual(answers, {self.nps.id: 6, self.select_all.id: 8, self.comment.id: 4})
+
+    def test_subset(self):
+        matrix = ResponseMatrix.load(self.survey)
+        # Respondents who picked option 2
+        picked, choice_ids = matrix.indicator(self.select_all.id)
+        rows = picked[:, 2]
+        self.assertEqual(matrix.nps_totals(rows), {"promoters": 1, "passives": 1, "detractors": 0, "respondents": 2})
+        # The same respondents from the packed bitset of option 2
+        bits = matrix.bitsets[matrix.choice_positions([self.options[2].id])[0]]
+        self.assertEqual(list(matrix.rows_of(bits)), list(rows))
+        with self.assertRaises(KeyError):
+            matrix.choice_positions([-1])
+
+    def test_crosstab(self):
+        matrix = ResponseMatrix.load(self.survey)
+        table, option_ids, score_ids = matrix.crosstab(self.select_all.id, self.nps.id)
+        self.assertEqual(list(option_ids), [o.id for o in self.options])
+        self.assertEqual(table.shape, (3, 11))
+        self.assertEqual(table.sum(), 8)
+        # Option 0 was picked by the respondents who scored 10, 9 and 7
+        self.assertEqual([int(table[0, w]) for w in (10, 9, 7)], [1, 1, 1])
+
+    def test_code_and_weight_matrices(self):
+        matrix = ResponseMatrix.load(self.survey)
+        codes = matrix.code_matrix()
+        self.assertEqual(list(codes[:, 0]), [10, 9, 9, 7, 6, 0])
+        self.assertEqual(list(codes[4:, 1]), [-1, -1])
+        weights = matrix.weight_matrix()
+        self.assertEqual(weights[:, 0].mean(), 41 / 6.0)
+
+    def test_cached_per_version(self):
+        get_matrix(self.survey)
+        with self.assertNumQueries(0):
+            get_matrix(self.survey)
+        self.survey.bump_report_version()
+        with self.assertNumQueries(6):
+            get_matrix(self.survey)
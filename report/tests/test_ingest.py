@@ -0,0 +1,134 @@
+from django.test import TestCase
+from report.ingest import ingest_responses, sync_schema
+from report.models import Survey, Question, Choice, Respondent, Answer
+
+
+class IngestResponsesTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Ingest test")
+        self.select_one = Question.objects.create(sm_id="q1", text="Select-one question", survey=self.survey)
+        self.comment = Question.objects.create(sm_id="q2", text="Enter a comment here", survey=self.survey, open_ended=True)
+        for n in range(1, 4):
+            Choice.objects.create(sm_id="c%d" % n, text="Option %d" % n, weight=n, question=self.select_one)
+        self.responses = [
+            {"respondent_id": "r1", "questions": [
+                {"question_id": "q1", "answers": [{"row": "c1"}]},
+                {"question_id": "q2", "answers": [{"text": "Survey taker 1"}]},
+            ]},
+            {"respondent_id": "r2", "questions": [
+                {"question_id": "q1", "answers": [{"row": "0", "col": "c3"}]},
+            ]},
+        ]
+
+    def test_ingest_responses(self):
+        stats = ingest_responses(self.survey, self.responses, chunk_size=1)
+        self.assertEqual(stats["respondents"], 2)
+        self.assertEqual(stats["respondent_questions"], 3)
+        self.assertEqual(stats["answers"], 3)
+        self.assertIn("rows_per_second", stats)
+        answer_list = Answer.objects.values_list(
+            "respondent__sm_id", "question__sm_id", "choice__sm_id", "text").order_by("respondent__sm_id", "question__sm_id")
+        expected = [
+            (u'r1', u'q1', u'c1', None),
+            (u'r1', u'q2', None, u'Survey taker 1'),
+            (u'r2', u'q1', u'c3', None),
+        ]
+        self.assertEqual(list(answer_list), expected)
+        self.assertEqual(self.select_one.respondent_set.count(), 2)
+        self.assertEqual(self.comment.respondent_set.count(), 1)
+
+    def test_ingest_responses_twice(self):
+        ingest_responses(self.survey, self.responses)
+        stats = ingest_responses(self.survey, iter(self.responses))
+        self.assertEqual(stats["respondents"], 0)
+        self.assertEqual(stats["skipped"], 2)
+        self.assertEqual(Respondent.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 3)
+
+    def test_repeated_respondent_in_chunk(self):
+        response = dict(self.responses[0], date_modified="2015-11-26 10:00:00")
+        since = "2015-11-25 00:00:00"
+        stats = ingest_responses(self.survey, [response, dict(response)], modified_since=since)
+        self.assertEqual((stats["respondents"], stats["skipped"]), (1, 1))
+        # Also once edited: answers replaced, links written once
+        stats = ingest_responses(self.survey, [response, dict(response)], modified_since=since)
+        self.assertEqual((stats["replaced"], stats["skipped"]), (1, 1))
+        self.assertEqual(Respondent.questions.through.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 2)
+
+    def test_ingest_responses_query_count(self):
+        # 3 preload queries, then per chunk: 1 insert + 1 id lookup
+        # + 1 M2M insert + 1 answer insert, plus the savepoint
+        # pair wrapping the transaction inside the test case
+        many = [
+            {"respondent_id": "r%d" % n, "questions": [
+                {"question_id": "q1", "answers": [{"row": "c2"}]},
+            ]}
+            for n in range(50)
+        ]
+        with self.assertNumQueries(9):
+            ingest_responses(self.survey, many, chunk_size=100)
+        self.assertEqual(Answer.objects.count(), 50)
+
+
+def survey_pages(option_1="Option 1", n_questions=2):
+    '''
+    get_survey_details payload with a descriptive text block and
+    n_questions select-one questions of 3 choices each
+    '''
+    questions = [{
+        "question_id": "intro",
+        "heading": "Welcome",
+        "type": {"family": "presentation", "subtype": "descriptive_text"},
+        "answers": [],
+    }]
+    for n in range(n_questions):
+        questions.append({
+            "question_id": "q%d" % n,
+            "heading": "Question %d" % n,
+            "type": {"family": "single_choice", "subtype": "vertical"},
+            "answers": [
+                {"answer_id": "q%d-c1" % n, "text": option_1, "weight": 1},
+                {"answer_id": "q%d-c2" % n, "text": "Option 2", "weight": 2},
+                {"answer_id": "q%d-c3" % n, "text": "Option 3"},
+                {"answer_id": "q%d-other" % n, "text": ""},
+            ],
+        })
+    return [{"page_id": "p1", "questions": questions}]
+
+
+class SyncSchemaTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Schema test")
+
+    def test_sync_schema(self):
+        changed, nps_changed = sync_schema(self.survey, survey_pages())
+        self.assertEqual(len(changed), 2)
+        self.assertFalse(nps_changed)
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(Choice.objects.count(), 6)
+        choices = Choice.objects.filter(question__sm_id="q0").values_list("sm_id", "text", "weight").order_by("sm_id")
+        expected = [(u'q0-c1', u'Option 1', 1), (u'q0-c2', u'Option 2', 2), (u'q0-c3', u'Option 3', None)]
+        self.assertEqual(list(choices), expected)
+
+    def test_sync_schema_twice(self):
+        sync_schema(self.survey, survey_pages())
+        self.assertEqual(sync_schema(self.survey, survey_pages()), (set(), False))
+        self.assertEqual(Question.objects.count(), 2)
+        self.assertEqual(Choice.objects.count(), 6)
+
+    def test_choice_text_change_keeps_choice(self):
+        sync_schema(self.survey, survey_pages())
+        choice = Choice.objects.get(sm_id="q0-c1")
+        sync_schema(self.survey, survey_pages(option_1="First option"))
+        self.assertEqual(Choice.objects.count(), 6)
+        self.assertEqual(Choice.objects.get(pk=choice.pk).text, u"First option")
+
+    def test_sync_schema_query_count(self):
+        # 2 loads, then question insert + id lookup and choice insert,
+        # plus the savepoint pair; independent of survey size
+        with self.assertNumQueries(7):
+            sync_schema(self.survey, survey_pages(n_questions=30))
+        # 2 loads, then one batched UPDATE for the renamed choices
+        with self.assertNumQueries(5):
+            sync_schema(self.survey, survey_pages(option_1="First option", n_questions=30))
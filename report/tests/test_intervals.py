@@ -0,0 +1,35 @@
+import numpy as np
+from django.test import SimpleTestCase
+from report.intervals import wilson_interval, nps_interval, bootstrap_proportions, bootstrap_nps
+
+
+class IntervalsTestCase(SimpleTestCase):
+    def test_wilson_interval(self):
+        low, high = wilson_interval([3, 0, 0], [6, 10, 0])
+        self.assertAlmostEqual(low[0], 0.1876, places=4)
+        self.assertAlmostEqual(high[0], 0.8124, places=4)
+        # No answers out of 10 still leaves room above 0
+        self.assertEqual(low[1], 0)
+        self.assertAlmostEqual(high[1], 0.2775, places=4)
+        self.assertTrue(np.isnan(low[2]) and np.isnan(high[2]))
+
+    def test_nps_interval(self):
+        # 3 promoters, 2 passives, 1 detractor: NPS 33
+        low, high = nps_interval(3, 1, 6)
+        self.assertAlmostEqual(float(low), -26.31, places=2)
+        self.assertAlmostEqual(float(high), 92.97, places=2)
+        # Narrower with more respondents
+        low, high = nps_interval([30, 300], [10, 100], [60, 600])
+        self.assertLess(high[1] - low[1], high[0] - low[0])
+
+    def test_bootstrap(self):
+        low, high = bootstrap_nps([3, 300, 0], [1, 100, 0], [6, 600, 0])
+        self.assertTrue(low[0] < 33 < high[0])
+        # Close to the analytic interval once samples are large
+        self.assertAlmostEqual(low[1], float(nps_interval(300, 100, 600)[0]), delta=1.5)
+        self.assertTrue(np.isnan(low[2]))
+        low, high = bootstrap_proportions([3, 3, 0], [6, 6, 0])
+        self.assertTrue(low[0] < 0.5 < high[0])
+        # Repeated pairs share their interval, which is stable
+        self.assertEqual((low[0], high[0]), (low[1], high[1]))
+        self.assertEqual(list(bootstrap_proportions([3], [6])[0]), [low[0]])
@@ -1,24 +1,25 @@
-import os
-import time
-from django.test import TestCase
-from sm_api import SurveyMonkeyClient
-from report.models import Survey, Question, Choice, Respondent, Answer
+from datetime import date
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from report.ingest import ingest_responses
+from report.tests.test_sm_api import StubSurveyMonkeyClient
+from report.models import Survey, Question, Choice, Respondent, Answer, SurveyStats, QuestionStats, ChoiceStats, SyncJob, NpsBucket
 
 
+# Talk to a replay of the survey on SurveyMonkey, see sm_fake
+fake_surveymonkey = override_settings(
+    SURVEYMONKEY_TRANSPORT='sm_fake.recorded_adapter',
+    SURVEYMONKEY_REQUESTS_PER_SECOND=1000,
+)
+
+
+@fake_surveymonkey
 class SurveyTestCase(TestCase):
     @classmethod
     def setUpTestData(self):
-        # Read SurveyMonkey API Token & Key
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        self.client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
-        # Create a survey and connect to SurveyMonkey via client
         self.survey = Survey.objects.create(name="Mike Test - DO NOT USE")
 
-    def tearDown(self):
-        # Cool down 1 second to comply with SurveyMonkey API
-        time.sleep(1)
-
     def test_update_details_for_nonexistent_survey(self):
         fake_survey = Survey.objects.create(name="Does not exist")
         fake_survey.update_details()
@@ -82,8 +83,6 @@ class SurveyTestCase(TestCase):
         self.survey.update_details()
         self.assertEqual(Question.objects.count(), 4)
         self.assertEqual(Choice.objects.count(), 11)
-        # Wait for 1 second before making the second call to comply with API
-        time.sleep(1)
         self.survey.update_details()
         self.assertEqual(Question.objects.count(), 4)
         self.assertEqual(Choice.objects.count(), 11)
@@ -126,31 +125,21 @@ class SurveyTestCase(TestCase):
         self.survey.download_responses()
         self.assertEqual(Respondent.objects.count(), 5)
         self.assertEqual(Answer.objects.count(), 26)
-        # Wait for 1 second before making the second call to comply with API
-        time.sleep(1)
         self.survey.update_details()
         self.survey.download_responses()
         self.assertEqual(Respondent.objects.count(), 5)
         self.assertEqual(Answer.objects.count(), 26)
 
 
+@fake_surveymonkey
 class QuestionTestCase(TestCase):
     @classmethod
     def setUpTestData(self):
-        # Read SurveyMonkey API Token & Key
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        self.client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
-        # Create a survey and connect to SurveyMonkey via client
         self.survey = Survey.objects.create(name="Mike Test - DO NOT USE")
         # Download responses
         self.survey.update_details()
         self.survey.download_responses()
 
-    def tearDown(self):
-        # Cool down 1 second to comply with SurveyMonkey API
-        time.sleep(1)
-
     def test_helper_count_responses(self):
         question = self.survey.question_set.get(text="This is a select-one question with weighting")
         # Two people select Not available
@@ -158,26 +147,295 @@ class QuestionTestCase(TestCase):
         self.assertEqual(na_count, 2)
 
 
+@fake_surveymonkey
 class ChoiceTestCase(TestCase):
     @classmethod
     def setUpTestData(self):
-        # Read SurveyMonkey API Token & Key
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        self.client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
-        # Create a survey and connect to SurveyMonkey via client
         self.survey = Survey.objects.create(name="Mike Test - DO NOT USE")
         # Download responses
         self.survey.update_details()
         self.survey.download_responses()
 
-    def tearDown(self):
-        # Cool down 1 second to comply with SurveyMonkey API
-        time.sleep(1)
-
     def test_raw_percentage(self):
         select_all = Question.objects.get(text="Select-all question")
         choice_1 = select_all.choice_set.get(text="Option 1")
         self.assertEqual(select_all.respondent_set.count(), 5)
         self.assertEqual(select_all.answer_set.count(), 12)
         self.assertEqual(choice_1.raw_percentage, 0.8)
+
+
+class NetPromoterScoreTestCase(TestCase):
+    @classmethod
+    def setUpTestData(self):
+        # Build an NPS question locally, no API call needed
+        self.survey = Survey.objects.create(name="NPS test")
+        question = Question.objects.create(sm_id="q1", text="How likely are you to recommend us?", survey=self.survey, nps=True)
+        choices = dict(
+            (weight, Choice.objects.create(sm_id="c%d" % weight, text=str(weight), weight=weight, question=question))
+            for weight in range(0, 11)
+        )
+        # 3 promoters, 1 passive, 2 detractors
+        for n, weight in enumerate([10, 9, 9, 7, 6, 0]):
+            respondent = Respondent.objects.create(sm_id="r%d" % n, survey=self.survey)
+            respondent.questions.add(question)
+            Answer.objects.create(question=question, respondent=respondent, choice=choices[weight])
+
+    def test_nps_breakdown(self):
+        question = self.survey.question_set.get()
+        expected = {question.id: {"promoters": 3, "passives": 1, "detractors": 2, "respondents": 6}}
+        self.assertEqual(self.survey.nps_breakdown(), expected)
+
+    def test_net_promoter_score(self):
+        survey = Survey.objects.get(pk=self.survey.pk)
+        # All NPS figures on the report share one query
+        with self.assertNumQueries(1):
+            self.assertEqual(survey.promoters_count, 3)
+            self.assertEqual(survey.passives_count, 1)
+            self.assertEqual(survey.detractors_count, 2)
+            self.assertEqual(survey.promoters_prop, 50)
+            self.assertEqual(survey.passives_prop, 17)
+            self.assertEqual(survey.detractors_prop, 33)
+            self.assertEqual(survey.net_promoter_score, 17)
+
+    def test_net_promoter_score_without_nps_questions(self):
+        survey = Survey.objects.create(name="No NPS")
+        self.assertIsNone(survey.net_promoter_score)
+        self.assertIsNone(survey.promoters_prop)
+
+    def test_refresh_stats(self):
+        self.survey.refresh_stats()
+        stats = SurveyStats.objects.get(survey=self.survey)
+        self.assertEqual(stats.respondent_count, 6)
+        self.assertEqual(stats.question_count, 1)
+        self.assertEqual(stats.net_promoter_score, 17)
+        self.assertEqual(stats.promoters_prop, 50)
+        question = self.survey.question_set.get()
+        self.assertEqual(question.stats.respondent_count, 6)
+        self.assertEqual(question.stats.answer_count, 6)
+        choice = question.choice_set.get(weight=9)
+        self.assertEqual(choice.stats.answer_count, 2)
+        self.assertEqual(choice.stats.raw_percentage, choice.raw_percentage)
+        # Refreshing only some questions leaves one stats row per object
+        self.survey.refresh_stats([question.id])
+        self.assertEqual(QuestionStats.objects.count(), 1)
+        self.assertEqual(ChoiceStats.objects.count(), 11)
+
+    def test_refresh_stats_backfills_missing_rollups(self):
+        # Data from before the rollups: refreshing no question in
+        # particular still builds the missing rows
+        self.survey.refresh_stats([])
+        question = self.survey.question_set.get()
+        self.assertEqual(QuestionStats.objects.get().answer_count, 6)
+        self.assertEqual(ChoiceStats.objects.count(), 11)
+        ChoiceStats.objects.filter(choice__weight=9).delete()
+        self.survey.refresh_stats([])
+        self.assertEqual(question.choice_set.get(weight=9).stats.answer_count, 2)
+
+
+class SurveyIdTestCase(TestCase):
+    def test_download_responses_stores_sm_id(self):
+        survey = Survey.objects.create(name="Stub survey")
+        api_client = StubSurveyMonkeyClient(3)
+        survey.get_client = lambda: api_client
+        survey.download_responses()
+        self.assertEqual(Survey.objects.get(pk=survey.pk).sm_id, u"1")
+        self.assertEqual(survey.respondent_set.count(), 3)
+        # The name was looked up once, for both fetching and storing
+        list_calls = [c for c in api_client.calls if c[0].endswith("get_survey_list")]
+        self.assertEqual(len(list_calls), 1)
+
+
+class IncrementalSyncTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Stub survey")
+        question = Question.objects.create(sm_id="q1", text="Select-one question", survey=self.survey)
+        Choice.objects.create(sm_id="c1", text="Option 1", question=question)
+        Choice.objects.create(sm_id="c2", text="Option 2", question=question)
+        self.api_client = StubSurveyMonkeyClient(3)
+        for r in self.api_client.respondent_ids:
+            self.api_client.questions[r] = [{"question_id": "q1", "answers": [{"row": "c1"}]}]
+        self.survey.get_client = lambda: self.api_client
+
+    def test_incremental_download(self):
+        self.survey.download_responses(incremental=True)
+        survey = Survey.objects.get(pk=self.survey.pk)
+        survey.get_client = lambda: self.api_client
+        self.assertEqual(survey.last_response_modified.year, 2015)
+        # Respondent 2 changes their answer and respondent 3 shows up
+        self.api_client.respondent_ids.append("3")
+        self.api_client.modified.update({"2": "2015-11-26 09:00:00", "3": "2015-11-26 10:00:00"})
+        self.api_client.questions["2"] = [{"question_id": "q1", "answers": [{"row": "c2"}]}]
+        self.api_client.questions["3"] = [{"question_id": "q1", "answers": [{"row": "c2"}]}]
+        self.api_client.calls = []
+        stats = survey.download_responses(incremental=True)
+        list_call = [data for endpoint, data in self.api_client.calls if endpoint.endswith("get_respondent_list")][0]
+        self.assertEqual(list_call["start_modified_date"], "2015-11-25 18:00:00")
+        self.assertEqual(stats["respondents"], 1)
+        self.assertEqual(stats["replaced"], 1)
+        answers = Answer.objects.values_list("respondent__sm_id", "choice__sm_id").order_by("respondent__sm_id")
+        self.assertEqual(list(answers), [(u"0", u"c1"), (u"1", u"c1"), (u"2", u"c2"), (u"3", u"c2")])
+        self.assertEqual(survey.question_set.get().stats.answer_count, 4)
+        self.assertEqual(str(Survey.objects.get(pk=survey.pk).last_response_modified), "2015-11-26 10:00:00+00:00")
+
+
+class RollupDeltasTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Stub survey")
+        nps = Question.objects.create(sm_id="q1", text="How likely?", survey=self.survey, nps=True)
+        for weight in range(0, 11):
+            Choice.objects.create(sm_id="c%d" % weight, text=str(weight), weight=weight, question=nps)
+        Question.objects.create(sm_id="q2", text="Comments?", survey=self.survey, open_ended=True)
+        select_all = Question.objects.create(sm_id="q3", text="Select all", survey=self.survey)
+        for n in range(3):
+            Choice.objects.create(sm_id="o%d" % n, text="Option %d" % n, question=select_all)
+        self.api_client = StubSurveyMonkeyClient(4)
+        for r, weight in zip(self.api_client.respondent_ids, [10, 9, 7, 0]):
+            self.api_client.questions[r] = [
+                {"question_id": "q1", "answers": [{"row": "c%d" % weight}]},
+                {"question_id": "q2", "answers": [{"text": "Respondent %s" % r}]},
+                {"question_id": "q3", "answers": [{"row": "o0"}, {"row": "o%d" % (int(r) % 3)}]},
+            ]
+        self.survey.get_client = lambda: self.api_client
+        # As update_details() leaves them
+        self.survey.refresh_stats()
+
+    def rollups(self):
+        survey = SurveyStats.objects.get(survey=self.survey)
+        return (
+            (survey.respondent_count, survey.nps_respondents, survey.nps_promoters,
+             survey.nps_passives, survey.nps_detractors),
+            sorted(QuestionStats.objects.values_list("question_id", "respondent_count", "answer_count")),
+            sorted(ChoiceStats.objects.values_list("choice_id", "answer_count", "raw_percentage")),
+        )
+
+    def test_incremental_sync_matches_recount(self):
+        self.survey.download_responses(incremental=True)
+        self.assertEqual(self.rollups()[0], (4, 4, 2, 1, 1))
+        # Respondent 1 turns detractor and drops their comment,
+        # respondent 4 shows up without answering the NPS question
+        self.api_client.respondent_ids.append("4")
+        self.api_client.modified.update({"1": "2015-11-26 09:00:00", "4": "2015-11-26 10:00:00"})
+        self.api_client.questions["1"] = [
+            {"question_id": "q1", "answers": [{"row": "c3"}]},
+            {"question_id": "q3", "answers": [{"row": "o2"}]},
+        ]
+        self.api_client.questions["4"] = [{"question_id": "q3", "answers": [{"row": "o1"}]}]
+        self.survey.download_responses(incremental=True)
+        updated = self.rollups()
+        self.assertEqual(updated[0], (5, 4, 1, 1, 2))
+        self.survey.refresh_stats()
+        self.assertEqual(updated, self.rollups())
+
+    def test_deltas_skip_answer_table(self):
+        stats = ingest_responses(self.survey, self.api_client.get_responses("Stub survey"))
+        with CaptureQueriesContext(connection) as queries:
+            self.survey.apply_stats_deltas(stats["deltas"])
+        self.assertFalse([q for q in queries if '"report_answer"' in q["sql"]])
+        self.assertEqual(self.survey.stats.net_promoter_score, 25)
+
+
+class NpsTrendTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Stub survey")
+        question = Question.objects.create(sm_id="q1", text="How likely?", survey=self.survey, nps=True)
+        for weight in range(0, 11):
+            Choice.objects.create(sm_id="c%d" % weight, text=str(weight), weight=weight, question=question)
+        self.api_client = StubSurveyMonkeyClient(4)
+        # UTC dates; the Los Angeles days are Nov 24, Nov 25 and Dec 1
+        self.api_client.modified = {
+            "0": "2015-11-25 06:00:00",
+            "1": "2015-11-25 18:00:00",
+            "2": "2015-11-26 02:00:00",
+            "3": "2015-12-01 20:00:00",
+        }
+        for r, weight in zip(self.api_client.respondent_ids, [10, 0, 9, 7]):
+            self.api_client.questions[r] = [{"question_id": "q1", "answers": [{"row": "c%d" % weight}]}]
+        self.survey.get_client = lambda: self.api_client
+
+    def test_nps_trend(self):
+        self.survey.download_responses()
+        days = [(t["start"], t["respondents"], t["score"]) for t in self.survey.nps_trend()]
+        self.assertEqual(days, [(date(2015, 11, 24), 1, 100), (date(2015, 11, 25), 2, 0), (date(2015, 12, 1), 1, 0)])
+        weeks = [(t["start"], t["promoters"], t["detractors"]) for t in self.survey.nps_trend("week")]
+        self.assertEqual(weeks, [(date(2015, 11, 23), 2, 1), (date(2015, 11, 30), 0, 0)])
+        months = self.survey.nps_trend("month")
+        self.assertEqual([(t["start"], t["respondents"], t["passives"]) for t in months],
+                         [(date(2015, 11, 1), 3, 0), (date(2015, 12, 1), 1, 1)])
+
+    def test_incremental_update(self):
+        self.survey.download_responses(incremental=True)
+        # Respondent 1 edits their answer a week later: only the day
+        # they first submitted on is rebuilt, and they stay on it
+        self.api_client.modified["1"] = "2015-12-02 20:00:00"
+        self.api_client.questions["1"] = [{"question_id": "q1", "answers": [{"row": "c10"}]}]
+        stats = self.survey.download_responses(incremental=True)
+        self.assertEqual(stats["days"], [date(2015, 11, 25)])
+        bucket = NpsBucket.objects.get(day=date(2015, 11, 25))
+        self.assertEqual((bucket.promoters, bucket.detractors), (2, 0))
+        self.assertEqual(NpsBucket.objects.count(), 3)
+
+    def test_weight_correction_rebuilds_trend(self):
+        self.survey.download_responses()
+        self.assertEqual(self.survey.nps_trend()[0]["score"], 100)
+        # The scale was reversed in SurveyMonkey: c10 now weighs 0
+        self.api_client.pages = [{"page_id": "p1", "questions": [{
+            "question_id": "q1", "heading": "How likely?",
+            "type": {"family": "single_choice", "subtype": "horiz"},
+            "answers": [{"answer_id": "c%d" % w, "text": str(w), "weight": 10 - w} for w in range(11)],
+        }]}]
+        self.survey.update_details()
+        self.assertEqual(self.survey.nps_trend()[0]["score"], -100)
+        self.assertEqual(SurveyStats.objects.get(survey=self.survey).net_promoter_score, -50)
+
+    def test_backfill_submitted(self):
+        # Respondents downloaded before submission dates were kept
+        for r in self.api_client.respondent_ids:
+            Respondent.objects.create(sm_id=r, survey=self.survey)
+        stats = self.survey.download_responses()
+        self.assertEqual(stats["skipped"], 4)
+        self.assertEqual(Respondent.objects.filter(submitted__isnull=True).count(), 0)
+        self.assertEqual(len(stats["days"]), 3)
+
+
+class SyncJobTestCase(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Stub survey")
+        self.other_survey = Survey.objects.create(name="Other survey")
+
+    def test_enqueue(self):
+        job = SyncJob.enqueue(self.survey)
+        self.assertEqual(SyncJob.enqueue(self.survey), job)
+        # A full sync request upgrades the queued job
+        SyncJob.enqueue(self.survey, incremental=False)
+        self.assertFalse(SyncJob.objects.get(pk=job.pk).incremental)
+        self.assertEqual(SyncJob.objects.count(), 1)
+
+    def test_claim_next_skips_surveys_being_synced(self):
+        running = SyncJob.enqueue(self.survey)
+        self.assertEqual(SyncJob.claim_next(), running)
+        # Queued again while the first job is still running
+        SyncJob.enqueue(self.survey)
+        other = SyncJob.enqueue(self.other_survey)
+        self.assertEqual(SyncJob.claim_next(), other)
+        self.assertIsNone(SyncJob.claim_next())
+
+    def test_run(self):
+        job = SyncJob.enqueue(self.survey)
+        job = SyncJob.claim_next()
+        job.survey.get_client = lambda: StubSurveyMonkeyClient(2)
+        job.run()
+        job = SyncJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, SyncJob.DONE)
+        self.assertIsNotNone(job.duration)
+        self.assertEqual(self.survey.respondent_set.count(), 2)
+
+    def test_run_keeps_edits_made_during_sync(self):
+        SyncJob.enqueue(self.survey)
+        job = SyncJob.claim_next()
+        job.survey.get_client = lambda: StubSurveyMonkeyClient(2)
+        # Renamed in the admin while the job runs
+        Survey.objects.filter(pk=self.survey.pk).update(name="Renamed survey")
+        job.run()
+        survey = Survey.objects.get(pk=self.survey.pk)
+        self.assertEqual(survey.name, "Renamed survey")
+        self.assertEqual(survey.sm_id, u"1")
@@ -1,24 +1,17 @@
-import os
-import time
+import requests
 from django.test import TestCase
-from sm_api import SurveyMonkeyClient
+from report.models import Survey
+from sm_api import SurveyMonkeyClient, RateLimiter, QuotaExceeded, shared_rate_limiter
+from sm_fake import fake_client, recorded_survey, generate_survey
 
 
 class SMClientTestCase(TestCase):
     @classmethod
     def setUpTestData(self):
-        # Read SurveyMonkey API Token & Key
-        SURVEYMONKEY_API_TOKEN = os.environ.get('SURVEYMONKEY_API_TOKEN')
-        SURVEYMONKEY_API_KEY = os.environ.get('SURVEYMONKEY_API_KEY')
-        self.api_client = SurveyMonkeyClient(SURVEYMONKEY_API_TOKEN, SURVEYMONKEY_API_KEY)
-        # Create a survey and connect to SurveyMonkey via client
+        # Replay of the survey on SurveyMonkey, see sm_fake
+        self.api_client = fake_client([recorded_survey()])
         self.survey_name = "Mike Test - DO NOT USE"
 
-    def tearDown(self):
-        # Add a second wait in between each test
-        # To prevent running over API quota
-        time.sleep(1)
-
     def test_get_survey_list(self):
         '''
         Test that the client will return a list of dict
@@ -58,3 +51,203 @@ class SMClientTestCase(TestCase):
         respondent_ids = [r['respondent_id'] for r in responses]
         expected_resp_ids = [u'4352787778', u'4352787305', u'4352786821', u'4352786417', u'4352785923']
         self.assertEqual(respondent_ids, expected_resp_ids)
+
+
+class StubSurveyMonkeyClient(SurveyMonkeyClient):
+    '''
+    Client that answers post_request from memory for
+    n_respondents respondents and records every call
+    '''
+    def __init__(self, n_respondents, **kwargs):
+        kwargs.setdefault("requests_per_second", 1000)
+        super(StubSurveyMonkeyClient, self).__init__("token", "key", **kwargs)
+        self.respondent_ids = [str(n) for n in range(n_respondents)]
+        self.pages = []
+        # Respondent ID -> date_modified / questions list, if set
+        self.modified = {}
+        self.questions = {}
+        self.calls = []
+
+    def post_request(self, endpoint, data):
+        self.calls.append((endpoint, data))
+        if endpoint.endswith("get_survey_list"):
+            return {"data": {"surveys": [{"survey_id": "1"}]}}
+        if endpoint.endswith("get_survey_details"):
+            return {"data": {"pages": self.pages}}
+        if endpoint.endswith("get_respondent_list"):
+            respondents = [
+                {"respondent_id": r, "date_modified": self.modified.get(r, "2015-11-25 18:00:00")}
+                for r in self.respondent_ids
+            ]
+            if "start_modified_date" in data:
+                respondents = [r for r in respondents if r["date_modified"] >= data["start_modified_date"]]
+            start = (data["page"] - 1) * data["page_size"]
+            return {"data": {"respondents": respondents[start:start + data["page_size"]]}}
+        if endpoint.endswith("get_responses"):
+            return {"data": [{"respondent_id": r, "questions": self.questions.get(r, [])} for r in data["respondent_ids"]]}
+
+
+class PaginationTestCase(TestCase):
+    def test_iter_respondent_ids(self):
+        api_client = StubSurveyMonkeyClient(25)
+        respondent_ids = list(api_client.iter_respondent_ids("1", page_size=10))
+        self.assertEqual(respondent_ids, api_client.respondent_ids)
+        # 3 pages, the last one short
+        self.assertEqual(len(api_client.calls), 3)
+
+    def test_iter_responses(self):
+        api_client = StubSurveyMonkeyClient(250)
+        responses = api_client.iter_responses("Stub survey", batch_size=100)
+        # Nothing but the survey ID lookup happens until iteration starts
+        self.assertEqual(len(api_client.calls), 1)
+        respondent_ids = [r["respondent_id"] for r in responses]
+        self.assertEqual(respondent_ids, api_client.respondent_ids)
+        batches = [data["respondent_ids"] for endpoint, data in api_client.calls if endpoint.endswith("get_responses")]
+        self.assertEqual([len(b) for b in batches], [100, 100, 50])
+
+    def test_iter_responses_concurrently(self):
+        api_client = StubSurveyMonkeyClient(1050, max_workers=4, max_in_flight=3)
+        responses = api_client.iter_responses("Stub survey", batch_size=100)
+        # Responses still come back in respondent list order
+        respondent_ids = [r["respondent_id"] for r in responses]
+        self.assertEqual(respondent_ids, api_client.respondent_ids)
+        batches = [data["respondent_ids"] for endpoint, data in api_client.calls if endpoint.endswith("get_responses")]
+        self.assertEqual(len(batches), 11)
+
+    def test_survey_id_is_resolved_once(self):
+        api_client = StubSurveyMonkeyClient(10)
+        api_client.get_respondent_list("Stub survey")
+        api_client.get_responses("Stub survey")
+        list_calls = [c for c in api_client.calls if c[0].endswith("get_survey_list")]
+        self.assertEqual(len(list_calls), 1)
+
+    def test_remember_survey_id(self):
+        api_client = StubSurveyMonkeyClient(10)
+        api_client.remember_survey_id("Stub survey", "1")
+        api_client.get_responses("Stub survey")
+        list_calls = [c for c in api_client.calls if c[0].endswith("get_survey_list")]
+        self.assertEqual(list_calls, [])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        raise requests.HTTPError(self.status_code)
+
+
+class FakeSession(object):
+    '''
+    Stands in for requests.Session, replaying canned responses
+    '''
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def post(self, uri, data=None, timeout=None):
+        return self.responses.pop(0)
+
+
+class RateLimitTestCase(TestCase):
+    def test_rate_limiter(self):
+        clock = FakeClock()
+        limiter = RateLimiter(2, clock=clock.time, sleep=clock.sleep)
+        for n in range(6):
+            limiter.acquire()
+        # Burst of 2, then one request every half second
+        self.assertEqual(clock.now, 2.0)
+        self.assertEqual(limiter.throttled_waits, 4)
+
+    def test_daily_quota(self):
+        clock = FakeClock()
+        limiter = RateLimiter(10, per_day=3, clock=clock.time, sleep=clock.sleep)
+        for n in range(3):
+            limiter.acquire()
+        self.assertRaises(QuotaExceeded, limiter.acquire)
+        # Budget comes back the next day
+        clock.now += RateLimiter.DAY
+        limiter.acquire()
+
+    def test_shared_rate_limiter(self):
+        limiter = shared_rate_limiter("shared key", 2, 100)
+        self.assertIs(shared_rate_limiter("shared key", 2, 100), limiter)
+        self.assertIsNot(shared_rate_limiter("other key", 2, 100), limiter)
+        # New limits from settings take effect
+        self.assertEqual(shared_rate_limiter("shared key", 2, 50).per_day, 50)
+        # Every client from get_client() spends the same budget
+        survey = Survey(name="Any survey")
+        self.assertIs(survey.get_client().rate_limiter, survey.get_client().rate_limiter)
+
+    def test_retry_with_backoff(self):
+        clock = FakeClock()
+        api_client = SurveyMonkeyClient("token", "key")
+        api_client.rate_limiter = RateLimiter(1000, clock=clock.time, sleep=clock.sleep)
+        api_client.client = FakeSession([
+            FakeResponse(429, headers={"Retry-After": "3"}),
+            FakeResponse(503),
+            FakeResponse(200, {"data": {"surveys": []}}),
+        ])
+        self.assertEqual(api_client.get_survey_list("Anything"), [])
+        self.assertEqual(api_client.counters["retries"], 2)
+        # Retry-After is honoured, otherwise jittered backoff
+        self.assertEqual(clock.slept[0], 3)
+        self.assertTrue(0 <= clock.slept[1] <= 2 * SurveyMonkeyClient.BACKOFF_BASE)
+
+    def test_retry_gives_up(self):
+        clock = FakeClock()
+        api_client = SurveyMonkeyClient("token", "key")
+        api_client.rate_limiter = RateLimiter(1000, clock=clock.time, sleep=clock.sleep)
+        api_client.client = FakeSession([FakeResponse(500)] * (SurveyMonkeyClient.MAX_RETRIES + 1))
+        self.assertRaises(requests.HTTPError, api_client.get_survey_list, "Anything")
+        self.assertEqual(api_client.retries, SurveyMonkeyClient.MAX_RETRIES)
+
+
+class FakeSurveyMonkeyTestCase(TestCase):
+    def test_throttling(self):
+        clock = FakeClock()
+        api_client = fake_client([generate_survey(n_respondents=250)], throttle_every=3, retry_after=2)
+        api_client.rate_limiter.sleep = clock.sleep
+        responses = list(api_client.iter_responses("Synthetic survey"))
+        self.assertEqual(len(responses), 250)
+        # Every third request is answered 429 and retried after Retry-After
+        self.assertEqual(api_client.counters["retries"], api_client.adapter.throttled)
+        self.assertTrue(api_client.adapter.throttled > 0)
+        self.assertEqual(set(clock.slept), set([2]))
+
+    def test_latency(self):
+        clock = FakeClock()
+        api_client = fake_client([recorded_survey()], latency=0.25, sleep=clock.sleep)
+        api_client.get_responses("Mike Test")
+        # Survey ID, one respondent page and one batch of responses
+        self.assertEqual(clock.now, 0.75)
+
+    def test_generate_survey(self):
+        survey = generate_survey(n_questions=10, n_choices=4, n_respondents=20, open_ended_share=0.2)
+        questions = survey.pages[0]["questions"]
+        families = [q["type"]["family"] for q in questions]
+        self.assertEqual(families.count("open_ended"), 2)
+        self.assertEqual(families.count("multiple_choice"), 2)
+        self.assertEqual(len(questions[0]["answers"]), 11)
+        self.assertEqual(len(questions[1]["answers"]), 4)
+        respondent_id = survey.respondents[7]["respondent_id"]
+        # Answers are reproduced on every request
+        self.assertEqual(survey.answers(respondent_id), survey.answers(respondent_id))
+        self.assertEqual(len(survey.answers(respondent_id)), 10)
@@ -0,0 +1,400 @@
+import json
+from datetime import datetime
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import utc
+from report.export import iter_answer_rows
+from report.models import Survey, Question, Choice, Respondent, Answer, SurveyStats
+from report.reports import report_cache_key
+
+
+def create_nps_survey(name, weights):
+    '''
+    Survey with one NPS question answered once per weight,
+    with its stats rollup refreshed
+    '''
+    survey = Survey.objects.create(name=name)
+    question = Question.objects.create(sm_id="q1", text="How likely are you to recommend us?", survey=survey, nps=True)
+    choices = dict(
+        (weight, Choice.objects.create(sm_id="c%d" % weight, text=str(weight), weight=weight, question=question))
+        for weight in range(0, 11)
+    )
+    for n, weight in enumerate(weights):
+        respondent = Respondent.objects.create(sm_id="r%d" % n, survey=survey)
+        respondent.questions.add(question)
+        Answer.objects.create(question=question, respondent=respondent, choice=choices[weight])
+    survey.refresh_stats()
+    return survey
+
+
+class SurveyListTestCase(TestCase):
+    def test_survey_list(self):
+        create_nps_survey("First survey", [10, 9, 9, 7, 6, 0])
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, "6 respondent(s)")
+        self.assertContains(response, "<td>17</td>", html=True)
+
+    def test_survey_list_query_count(self):
+        create_nps_survey("First survey", [10, 0])
+        # Sync state for the ETag, then the joined survey list
+        with self.assertNumQueries(2):
+            self.client.get(reverse('index'))
+        for n in range(5):
+            create_nps_survey("Survey %d" % n, [10, 9, 0])
+        # Never synced, so no stats rollup yet
+        Survey.objects.create(name="New survey")
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('index'))
+        self.assertContains(response, "New survey")
+
+
+class SurveyDetailTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = create_nps_survey("NPS survey", [10, 9, 9, 7, 6, 0])
+        comment = Question.objects.create(sm_id="q2", text="Enter a comment here", survey=self.survey, open_ended=True)
+        respondent = self.survey.respondent_set.get(sm_id="r0")
+        respondent.questions.add(comment)
+        Answer.objects.create(question=comment, respondent=respondent, text="Survey taker 1")
+        self.survey.refresh_stats()
+
+    def test_survey_detail(self):
+        response = self.client.get(reverse('detail', args=[self.survey.pk]))
+        report = response.context['report']
+        self.assertEqual(report['nps']['score'], 17)
+        self.assertEqual(report['nps']['promoters'], 3)
+        nps_question = report['questions'][1]
+        self.assertEqual(nps_question['respondent_count'], 6)
+        self.assertEqual([c['answer_count'] for c in nps_question['choices'] if c['weight'] == 9], [2])
+        self.assertContains(response, "Survey taker 1")
+        self.assertContains(response, "1 comment:")
+
+    def test_survey_detail_query_count(self):
+        # Sync state for the ETag, survey + stats, questions,
+        # choices, comments
+        with self.assertNumQueries(5):
+            self.client.get(reverse('detail', args=[self.survey.pk]))
+        for n in range(10):
+            question = Question.objects.create(sm_id="extra%d" % n, text="Extra %d" % n, survey=self.survey)
+            for m in range(4):
+                Choice.objects.create(sm_id="extra%d-%d" % (n, m), text="Option %d" % m, question=question)
+        self.survey.refresh_stats()
+        with self.assertNumQueries(5):
+            self.client.get(reverse('detail', args=[self.survey.pk]))
+
+
+class SurveyReportTestCase(TestCase):
+    def setUp(self):
+        self.survey = create_nps_survey("NPS survey", [10, 9, 9, 7, 6, 0])
+        comment = Question.objects.create(sm_id="q2", text="Any comments?", survey=self.survey, open_ended=True)
+        Answer.objects.create(question=comment, respondent=Respondent.objects.get(sm_id="r0"), text="Great")
+        self.survey.refresh_stats()
+        self.url = reverse('report', args=[self.survey.pk])
+
+    def test_survey_report(self):
+        # Sync state for the ETag, survey + stats, questions, choices
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        report = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(sorted(report), ["nps", "questions", "survey"])
+        self.assertEqual(report["nps"]["score"], 17)
+        self.assertEqual(report["survey"]["version"], self.survey.report_version)
+        comments, nps = report["questions"]
+        self.assertEqual(comments["answer_count"], 1)
+        self.assertNotIn("comments", comments)
+        self.assertEqual([c["answer_count"] for c in nps["choices"] if c["weight"] in (9, 10)], [2, 1])
+
+    def test_field_selection(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {"fields": "nps"})
+        self.assertEqual(list(json.loads(response.content.decode("utf-8"))), ["nps"])
+        response = self.client.get(self.url, {"fields": "questions,comments"})
+        comments = json.loads(response.content.decode("utf-8"))["questions"][0]
+        self.assertEqual([c["text"] for c in comments["comments"]], ["Great"])
+
+    def test_unknown_field(self):
+        response = self.client.get(self.url, {"fields": "nps,answers"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_intervals(self):
+        report = json.loads(self.client.get(self.url).content.decode("utf-8"))
+        self.assertEqual((report["nps"]["score_low"], report["nps"]["score_high"]), (-55, 88))
+        self.assertEqual(report["nps"]["confidence"], 0.95)
+        nps = report["questions"][1]
+        nines = [c for c in nps["choices"] if c["weight"] == 9][0]
+        self.assertTrue(nines["low"] < nines["raw_percentage"] < nines["high"])
+        with override_settings(REPORT_INTERVALS='bootstrap'):
+            report = json.loads(self.client.get(self.url).content.decode("utf-8"))
+        self.assertLess(report["nps"]["score_low"], 17)
+        with override_settings(REPORT_INTERVALS=None):
+            report = json.loads(self.client.get(self.url).content.decode("utf-8"))
+        self.assertNotIn("score_low", report["nps"])
+        self.assertNotIn("low", report["questions"][1]["choices"][0])
+
+
+class SurveyNpsTrendTestCase(TestCase):
+    def test_nps_trend(self):
+        survey = create_nps_survey("NPS survey", [10, 9, 0])
+        Respondent.objects.update(submitted=datetime(2015, 11, 25, 20, tzinfo=utc))
+        survey.refresh_nps_trend()
+        url = reverse('nps_trend', args=[survey.pk])
+        # Sync state for the ETag, survey, buckets
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {"period": "month"})
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"period": "month", "trend": [{
+            "start": "2015-11-01", "score": 33, "respondents": 3,
+            "promoters": 2, "passives": 0, "detractors": 1,
+        }]})
+        response = self.client.get(url, {"period": "year"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(COMMENTS_PAGE_SIZE=2)
+class QuestionCommentsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = Survey.objects.create(name="Comments survey")
+        self.question = Question.objects.create(sm_id="q1", text="Enter a comment here", survey=self.survey, open_ended=True)
+        for n in range(5):
+            respondent = Respondent.objects.create(sm_id="r%d" % n, survey=self.survey)
+            Answer.objects.create(question=self.question, respondent=respondent, text="Survey taker %d" % n)
+        self.survey.refresh_stats()
+        self.url = reverse('comments', args=[self.survey.pk, self.question.pk])
+
+    def test_report_ships_first_page(self):
+        response = self.client.get(reverse('detail', args=[self.survey.pk]))
+        self.assertContains(response, "5 comments:")
+        self.assertContains(response, "Survey taker 1")
+        self.assertNotContains(response, "Survey taker 2")
+
+    def test_first_pages_in_one_query(self):
+        url = reverse('report', args=[self.survey.pk])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {"fields": "questions,comments"})
+        for n in range(2, 5):
+            question = Question.objects.create(
+                sm_id="q%d" % n, text="Comment %d" % n, survey=self.survey, open_ended=True)
+            for respondent in Respondent.objects.order_by("id")[:n - 1]:
+                Answer.objects.create(question=question, respondent=respondent, text="%s on %d" % (respondent.sm_id, n))
+        self.survey.refresh_stats()
+        with self.assertNumQueries(len(queries)):
+            report = json.loads(self.client.get(url, {"fields": "questions,comments"}).content.decode("utf-8"))
+        pages = dict((q["text"], ([c["text"] for c in q["comments"]], q["comments_next"] is not None))
+                     for q in report["questions"])
+        self.assertEqual(pages, {
+            "Enter a comment here": (["Survey taker 0", "Survey taker 1"], True),
+            "Comment 2": (["r0 on 2"], False),
+            "Comment 3": (["r0 on 3", "r1 on 3"], False),
+            "Comment 4": (["r0 on 4", "r1 on 4"], True),
+        })
+
+    def test_comment_pages(self):
+        texts = []
+        after = ''
+        while after is not None:
+            page = json.loads(self.client.get(self.url, {'after': after}).content)
+            texts.extend(c['text'] for c in page['comments'])
+            after = page['next']
+        self.assertEqual(texts, ["Survey taker %d" % n for n in range(5)])
+
+    def test_comment_page_errors(self):
+        self.assertEqual(self.client.get(self.url, {'after': 'x'}).status_code, 400)
+        other = Survey.objects.create(name="Other survey")
+        url = reverse('comments', args=[other.pk, self.question.pk])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ReportCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = create_nps_survey("NPS survey", [10, 9, 9, 7, 6, 0])
+        self.url = reverse('detail', args=[self.survey.pk])
+
+    @override_settings(REPORT_CACHE='page')
+    def test_page_cache(self):
+        first = self.client.get(self.url)
+        # Only the sync state and survey lookups run on a cache hit
+        with self.assertNumQueries(2):
+            second = self.client.get(self.url)
+        self.assertEqual(first.content, second.content)
+        # A sync bumps report_version, so the page is rebuilt
+        SurveyStats.objects.filter(survey=self.survey).update(nps_promoters=5, nps_respondents=8)
+        self.assertContains(self.client.get(self.url), "N=3")
+        self.survey.bump_report_version()
+        self.assertContains(self.client.get(self.url), "N=5")
+
+    @override_settings(REPORT_CACHE='fragment')
+    def test_fragment_cache(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertIsNotNone(cache.get(report_cache_key(self.survey, 'fragment', 'nps')))
+        # With every fragment cached only the sync state and survey
+        # lookups run, none of the report's own
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+        self.assertGreater(len(queries), 2)
+        SurveyStats.objects.filter(survey=self.survey).update(nps_promoters=5, nps_respondents=8)
+        self.assertContains(self.client.get(self.url), "N=3")
+        self.survey.bump_report_version()
+        self.assertContains(self.client.get(self.url), "N=5")
+
+    @override_settings(REPORT_CACHE=None)
+    def test_no_cache(self):
+        self.client.get(self.url)
+        SurveyStats.objects.filter(survey=self.survey).update(nps_promoters=5, nps_respondents=8)
+        self.assertContains(self.client.get(self.url), "N=5")
+
+
+class SegmentTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = create_nps_survey("NPS survey", [10, 9, 9, 7, 6, 0])
+        self.nps = self.survey.question_set.get()
+        self.first_time = Question.objects.create(sm_id="q2", text="First time with us?", survey=self.survey)
+        self.yes = Choice.objects.create(sm_id="yes", text="Yes", question=self.first_time)
+        self.no = Choice.objects.create(sm_id="no", text="No", question=self.first_time)
+        self.comment = Question.objects.create(sm_id="q3", text="Any comments?", survey=self.survey, open_ended=True)
+        for n, respondent in enumerate(Respondent.objects.order_by("id")):
+            # First timers scored 10, 9 and 7
+            respondent.questions.add(self.first_time)
+            choice = self.yes if n in (0, 1, 3) else self.no
+            Answer.objects.create(question=self.first_time, respondent=respondent, choice=choice)
+            if n < 3:
+                respondent.questions.add(self.comment)
+                Answer.objects.create(question=self.comment, respondent=respondent, text="Comment %d" % n)
+        self.survey.refresh_stats()
+        self.url = reverse('report', args=[self.survey.pk])
+
+    def get_report(self, **params):
+        response = self.client.get(self.url, dict(params, fields="nps,questions,comments"))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode("utf-8"))
+
+    def test_answer_equals(self):
+        report = self.get_report(where="%d:%d" % (self.first_time.pk, self.yes.pk))
+        self.assertEqual(report["segment"]["respondents"], 3)
+        self.assertEqual(report["segment"]["conditions"][0]["choices"], ["Yes"])
+        self.assertEqual(report["nps"]["score"], 67)
+        self.assertEqual((report["nps"]["promoters"], report["nps"]["passives"]), (2, 1))
+        questions = dict((q["text"], q) for q in report["questions"])
+        first_time = questions["First time with us?"]
+        self.assertEqual(first_time["respondent_count"], 3)
+        self.assertEqual([(c["answer_count"], c["raw_percentage"]) for c in first_time["choices"]], [(3, 1), (0, 0)])
+        comments = questions["Any comments?"]
+        self.assertEqual(comments["answer_count"], 2)
+        self.assertEqual([c["text"] for c in comments["comments"]], ["Comment 0", "Comment 1"])
+
+    def test_answer_in_and_match(self):
+        scores = Choice.objects.filter(question=self.nps, weight__in=[9, 10]).order_by("id")
+        where = "%d:%s" % (self.nps.pk, ",".join(str(c.pk) for c in scores))
+        self.assertEqual(self.get_report(where=where)["segment"]["respondents"], 3)
+        no = "%d:%d" % (self.first_time.pk, self.no.pk)
+        self.assertEqual(self.get_report(where=[where, no])["segment"]["respondents"], 1)
+        report = self.get_report(where=[where, no], match="any")
+        self.assertEqual(report["segment"]["respondents"], 5)
+        self.assertEqual(report["nps"]["detractors"], 2)
+
+    def test_query_count(self):
+        where = "%d:%d" % (self.first_time.pk, self.yes.pk)
+        self.client.get(self.url, {"where": where})
+        # With the survey's bitsets cached, a segment costs the same
+        # queries as the unfiltered report
+        with self.assertNumQueries(4):
+            self.client.get(self.url, {"where": "%d:%d" % (self.first_time.pk, self.no.pk)})
+
+    def test_bad_segments(self):
+        for params in [
+            {"where": "first-time"},
+            {"where": "%d:%d" % (self.nps.pk, self.yes.pk)},
+            {"where": "%d:%d" % (self.first_time.pk, self.yes.pk), "match": "some"},
+        ]:
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+            self.assertEqual(self.client.get(reverse('detail', args=[self.survey.pk]), params).status_code, 400)
+
+    @override_settings(REPORT_CACHE='page')
+    def test_survey_detail(self):
+        url = reverse('detail', args=[self.survey.pk])
+        where = "%d:%d" % (self.first_time.pk, self.yes.pk)
+        self.assertContains(self.client.get(url), "N=3")
+        response = self.client.get(url, {"where": where})
+        self.assertContains(response, "Showing the 3 respondents who answered")
+        self.assertContains(response, "N=2")
+        # Comment boards page through the segment's comments only
+        self.assertContains(response, "?where=%d%%3A%d&amp;match=all" % (self.first_time.pk, self.yes.pk))
+        comments = reverse('comments', args=[self.survey.pk, self.comment.pk])
+        page = json.loads(self.client.get(comments, {"where": where, "after": 0}).content.decode("utf-8"))
+        self.assertEqual([c["text"] for c in page["comments"]], ["Comment 0", "Comment 1"])
+        # Cached apart from the unfiltered page
+        self.assertContains(self.client.get(url), "N=3")
+        self.assertContains(self.client.get(url, {"where": where}), "N=2")
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = create_nps_survey("NPS survey", [10, 9, 0])
+
+    def assertNotModified(self, url, **headers):
+        # Only the sync state is looked up
+        with self.assertNumQueries(1):
+            response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_survey_detail(self):
+        url = reverse('detail', args=[self.survey.pk])
+        response = self.client.get(url)
+        self.assertNotModified(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertNotModified(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        # A sync changes the ETag
+        self.survey.bump_report_version()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_survey_list(self):
+        url = reverse('index')
+        response = self.client.get(url)
+        self.assertNotModified(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        Survey.objects.create(name="New survey")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_survey(self):
+        response = self.client.get(reverse('detail', args=[self.survey.pk + 1]))
+        self.assertEqual(response.status_code, 404)
+
+
+class SurveyExportTestCase(TestCase):
+    def setUp(self):
+        self.survey = create_nps_survey("NPS survey", [10, 9, 0])
+        comment = Question.objects.create(sm_id="q2", text="Any comments?", survey=self.survey, open_ended=True)
+        Answer.objects.create(question=comment, respondent=Respondent.objects.get(sm_id="r0"), text=u"Caf\xe9, \"great\"")
+
+    def test_export_csv(self):
+        response = self.client.get(reverse('export', args=[self.survey.pk, 'csv']))
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual(lines[0], u"respondent_id,question_id,question,choice_id,choice,weight,text")
+        self.assertEqual(lines[1], u"r0,q1,How likely are you to recommend us?,c10,10,10,")
+        self.assertEqual(lines[4], u'r0,q2,Any comments?,,,,"Caf\xe9, ""great"""')
+        self.assertEqual(len(lines), 5)
+
+    def test_export_ndjson(self):
+        response = self.client.get(reverse('export', args=[self.survey.pk, 'ndjson']))
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()]
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[2]["weight"], 0)
+        self.assertEqual(rows[3]["text"], u"Caf\xe9, \"great\"")
+
+    def test_export_chunks(self):
+        # One keyset query per full chunk, plus the short last one
+        with self.assertNumQueries(3):
+            rows = list(iter_answer_rows(self.survey, chunk_size=2))
+        self.assertEqual([row[0] for row in rows], [u"r0", u"r1", u"r2", u"r0"])
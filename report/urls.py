@@ -5,4 +5,9 @@ from . import views
 urlpatterns = [
     url(r'^$', views.SurveyList.as_view(), name='index'),
     url(r'^(?P<pk>[0-9]+)/$', views.SurveyDetail.as_view(), name='detail'),
+    url(r'^(?P<pk>[0-9]+)/report\.json$', views.SurveyReport.as_view(), name='report'),
+    url(r'^(?P<pk>[0-9]+)/nps-trend\.json$', views.SurveyNpsTrend.as_view(), name='nps_trend'),
+    url(r'^(?P<pk>[0-9]+)/questions/(?P<question_pk>[0-9]+)/comments/$',
+        views.QuestionComments.as_view(), name='comments'),
+    url(r'^(?P<pk>[0-9]+)/export\.(?P<format>csv|ndjson)$', views.SurveyExport.as_view(), name='export'),
 ]
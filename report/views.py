@@ -1,11 +1,217 @@
-from django.views.generic import ListView
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.views.generic import ListView, View
 from django.views.generic.detail import DetailView
-from .models import Survey
+from .models import Survey, Question, NPS_TREND_PERIODS
+from .export import iter_answer_rows, csv_stream, ndjson_stream
+from .reports import REPORT_FIELDS, LazyReport, build_report, comment_page, report_cache_key
+from .segments import Segment, SegmentError
+
+# Upper bound on the limit parameter of QuestionComments
+MAX_COMMENTS_PAGE_SIZE = 200
+
+# Blocks of the JSON report sent when ?fields= is not given;
+# comments are paged separately through QuestionComments
+DEFAULT_REPORT_FIELDS = ("survey", "nps", "questions")
+
+
+def _list_state(request):
+    '''
+    (ETag, Last-Modified) of the survey index: changes when a
+    survey is added, removed, edited or synced. Computed with one
+    aggregate query and kept on the request for both callbacks
+    '''
+    if not hasattr(request, '_report_state'):
+        state = Survey.objects.order_by().aggregate(
+            count=Count('id'), version=Sum('report_version'), last_updated=Max('last_updated'))
+        etag = "list-{count}-{version}-{stamp}".format(
+            count=state['count'], version=state['version'] or 0,
+            stamp=_timestamp(state['last_updated']))
+        request._report_state = (etag, state['last_updated'])
+    return request._report_state
+
+
+def _detail_state(request, pk):
+    '''
+    (ETag, Last-Modified) of a survey report, from its
+    report_version and last_updated (both moved by every sync)
+    '''
+    if not hasattr(request, '_report_state'):
+        state = Survey.objects.filter(pk=pk).values_list('report_version', 'last_updated').first()
+        if state is None:
+            # Let the view answer with its 404
+            request._report_state = (None, None)
+        else:
+            version, last_updated = state
+            etag = "survey-{pk}-{version}-{stamp}".format(
+                pk=pk, version=version, stamp=_timestamp(last_updated))
+            request._report_state = (etag, last_updated)
+    return request._report_state
+
+
+# Answers 304 Not Modified while a survey has not been synced,
+# for the views of one survey's report
+survey_condition = condition(
+    etag_func=lambda request, pk: _detail_state(request, pk)[0],
+    last_modified_func=lambda request, pk: _detail_state(request, pk)[1],
+)
+
+
+def _timestamp(value):
+    return value.isoformat() if value else ''
 
 
 class SurveyList(ListView):
-    model = Survey
+    # Counts and NPS come joined in from the stats rollup,
+    # so the page costs one query however many surveys there are
+    queryset = Survey.objects.select_related('stats')
+
+    # Answer browser refreshes and pollers with 304 Not Modified
+    # while nothing has been synced, before any rendering work
+    @method_decorator(condition(
+        etag_func=lambda request, *args, **kwargs: _list_state(request)[0],
+        last_modified_func=lambda request, *args, **kwargs: _list_state(request)[1],
+    ))
+    def dispatch(self, *args, **kwargs):
+        return super(SurveyList, self).dispatch(*args, **kwargs)
 
 
 class SurveyDetail(DetailView):
-    model = Survey
+    # Report figures come from the stats rollups (see Survey.refresh_stats)
+    queryset = Survey.objects.select_related('stats')
+
+    @method_decorator(survey_condition)
+    def dispatch(self, *args, **kwargs):
+        return super(SurveyDetail, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        # Reports on part of the respondents, see Segment
+        try:
+            self.segment = Segment.from_query(request.GET)
+            return self.get_report(request, *args, **kwargs)
+        except SegmentError as e:
+            return HttpResponseBadRequest(str(e))
+
+    def get_report(self, request, *args, **kwargs):
+        if settings.REPORT_CACHE != 'page':
+            return super(SurveyDetail, self).get(request, *args, **kwargs)
+        # Whole-page cache, keyed on report_version so syncs invalidate it
+        self.object = self.get_object()
+        parts = ['page', self.segment.key] if self.segment else ['page']
+        key = report_cache_key(self.object, *parts)
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+        response = self.render_to_response(self.get_context_data(object=self.object))
+        response.add_post_render_callback(
+            lambda r: cache.set(key, r.content, settings.REPORT_CACHE_TIMEOUT))
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super(SurveyDetail, self).get_context_data(**kwargs)
+        # Templates only read plain values from the prebuilt report.
+        # Cached fragments need none of theirs, so blocks are then
+        # built only when their fragment is rendered
+        if settings.REPORT_CACHE == 'fragment':
+            context['report'] = LazyReport(self.object, segment=self.segment)
+        else:
+            context['report'] = build_report(self.object, segment=self.segment)
+        context['segment'] = self.segment
+        return context
+
+
+class SurveyReport(View):
+    '''
+    The aggregated report behind SurveyDetail as JSON, e.g.,
+        GET /surveys/1/report.json?fields=nps
+        {"nps": {"score": 17, "promoters": 3, ...}}
+    fields is a comma-separated subset of REPORT_FIELDS, see
+    build_report(). where and match narrow the report down to a
+    Segment of the respondents as on SurveyDetail. Answers 304
+    like SurveyDetail while the survey has not been synced
+    '''
+    @method_decorator(survey_condition)
+    def dispatch(self, *args, **kwargs):
+        return super(SurveyReport, self).dispatch(*args, **kwargs)
+
+    def get(self, request, pk):
+        if request.GET.get('fields'):
+            fields = request.GET['fields'].split(',')
+            unknown = set(fields) - set(REPORT_FIELDS)
+            if unknown:
+                return HttpResponseBadRequest("Unknown fields: {}".format(", ".join(sorted(unknown))))
+        else:
+            fields = DEFAULT_REPORT_FIELDS
+        survey = get_object_or_404(Survey.objects.select_related('stats'), pk=pk)
+        try:
+            return JsonResponse(build_report(survey, fields, Segment.from_query(request.GET)))
+        except SegmentError as e:
+            return HttpResponseBadRequest(str(e))
+
+
+class SurveyNpsTrend(View):
+    '''
+    Net Promoter Score per day, week or month as JSON, from the
+    daily buckets kept by Survey.refresh_nps_trend(), e.g.,
+        GET /surveys/1/nps-trend.json?period=week
+        {"period": "week", "trend": [{"start": "2015-11-23", "score": 29, ...}]}
+    '''
+    @method_decorator(survey_condition)
+    def dispatch(self, *args, **kwargs):
+        return super(SurveyNpsTrend, self).dispatch(*args, **kwargs)
+
+    def get(self, request, pk):
+        period = request.GET.get('period', 'day')
+        if period not in NPS_TREND_PERIODS:
+            return HttpResponseBadRequest("period must be one of {}".format(", ".join(NPS_TREND_PERIODS)))
+        survey = get_object_or_404(Survey, pk=pk)
+        return JsonResponse({"period": period, "trend": survey.nps_trend(period)})
+
+
+class QuestionComments(View):
+    '''
+    JSON pages of an open-ended question's comments for the
+    lazy-loading comment boards, e.g.,
+        GET /surveys/1/questions/2/comments/?after=345
+        {"comments": [{"id": 346, "text": "..."}], "next": 365}
+    where and match keep the comments of a Segment only
+    '''
+    def get(self, request, pk, question_pk):
+        question = get_object_or_404(Question, pk=question_pk, survey_id=pk, open_ended=True)
+        try:
+            after = int(request.GET['after']) if request.GET.get('after') else None
+            limit = min(int(request.GET.get('limit', settings.COMMENTS_PAGE_SIZE)), MAX_COMMENTS_PAGE_SIZE)
+        except ValueError:
+            return HttpResponseBadRequest("after and limit must be integers")
+        try:
+            segment = Segment.from_query(request.GET)
+        except SegmentError as e:
+            return HttpResponseBadRequest(str(e))
+        comments, next_cursor = comment_page(question.id, after, max(limit, 1), segment)
+        return JsonResponse({"comments": comments, "next": next_cursor})
+
+
+class SurveyExport(View):
+    '''
+    All answers of a survey, one row each, streamed as CSV or
+    newline-delimited JSON, e.g.,
+        GET /surveys/1/export.csv
+    Rows are read in keyset chunks while the response is being
+    sent, so large surveys start downloading at once
+    '''
+    formats = {
+        'csv': (csv_stream, 'text/csv; charset=utf-8'),
+        'ndjson': (ndjson_stream, 'application/x-ndjson'),
+    }
+
+    def get(self, request, pk, format):
+        survey = get_object_or_404(Survey, pk=pk)
+        stream, content_type = self.formats[format]
+        response = StreamingHttpResponse(stream(iter_answer_rows(survey)), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="survey-{pk}.{format}"'.format(pk=survey.pk, format=format)
+        return response
@@ -1,13 +1,126 @@
 import requests
 import json
+import random
+import threading
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QuotaExceeded(Exception):
+    '''
+    Raised when a client has used up its daily request budget
+    '''
+    pass
+
+
+class RateLimiter(object):
+    '''
+    Token bucket allowing per_second requests per second (with
+    bursts of up to per_second requests) and at most per_day
+    requests per rolling day. Thread-safe, so one limiter can be
+    shared by every call a client makes, including pool workers
+    '''
+    DAY = 24 * 60 * 60
+
+    def __init__(self, per_second, per_day=None, clock=time.time, sleep=time.sleep):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.clock = clock
+        self.sleep = sleep
+        self.capacity = max(per_second, 1)
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.day_started = self.updated
+        self.day_count = 0
+        # Number of times acquire() had to wait for a token
+        self.throttled_waits = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Block until a request may be sent, then consume a token
+        Raises QuotaExceeded if the daily budget is spent
+        '''
+        with self.lock:
+            while True:
+                now = self.clock()
+                if now - self.day_started >= self.DAY:
+                    self.day_started = now
+                    self.day_count = 0
+                if self.per_day is not None and self.day_count >= self.per_day:
+                    raise QuotaExceeded("Daily budget of {} requests used up".format(self.per_day))
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.day_count += 1
+                    return
+                self.throttled_waits += 1
+                self.sleep((1 - self.tokens) / self.per_second)
+
+
+# API key -> RateLimiter shared by every client of the process
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(api_key, per_second, per_day=None):
+    '''
+    The process-wide RateLimiter of api_key, so the clients
+    built for each sync (and each step of a sync) draw from one
+    per-second and per-day budget instead of starting afresh.
+    A limiter with different limits replaces the previous one
+    '''
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(api_key)
+        if limiter is None or (limiter.per_second, limiter.per_day) != (per_second, per_day):
+            limiter = _rate_limiters[api_key] = RateLimiter(per_second, per_day)
+        return limiter
 
 
 class SurveyMonkeyClient(object):
     HOST = "https://api.surveymonkey.net"
+    # Largest page get_respondent_list will return
+    RESPONDENT_PAGE_SIZE = 1000
+    # Most respondent IDs get_responses accepts in one call
+    RESPONSES_BATCH_SIZE = 100
+    # Retry policy for throttled (429), server (5xx) and network errors
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+    TIMEOUT = 60
+    # Format of dates sent to and returned by the API (UTC)
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    # Seconds a survey name -> survey ID lookup stays cached
+    SURVEY_ID_TTL = 60 * 60
 
-    def __init__(self, token, api_key):
+    def __init__(self, token, api_key, max_workers=1, max_in_flight=None,
+                 requests_per_second=2, requests_per_day=None, transport_adapter=None, rate_limiter=None):
+        '''
+        max_workers > 1 turns on concurrent fetching of
+        get_responses batches in iter_responses(), with at most
+        max_in_flight batches (default 2 per worker) requested
+        or buffered at any time
+
+        All requests go through one RateLimiter allowing
+        requests_per_second and, if given, requests_per_day,
+        or through rate_limiter if given, e.g., one from
+        shared_rate_limiter()
+
+        transport_adapter replaces the HTTP adapter requests are
+        sent through, e.g., with sm_fake.FakeSurveyMonkeyAdapter
+        '''
         self.token = token
         self.api_key = api_key
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or max_workers * 2
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_second, requests_per_day)
+        # Number of requests sent again after a 429, 5xx or network error
+        self.retries = 0
+        # Survey name -> (survey ID, expiry timestamp or None)
+        self._survey_ids = {}
         client = requests.session()
         client.headers = {
             "Authorization": "bearer {}".format(self.token),
@@ -16,6 +129,10 @@ class SurveyMonkeyClient(object):
         client.params = {
             "api_key": api_key
         }
+        # Keep one pooled connection per worker thread
+        adapter = transport_adapter or requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(max_workers, 1))
+        client.mount(self.HOST, adapter)
         self.client = client
 
     def post_request(self, endpoint, data):
@@ -24,11 +141,54 @@ class SurveyMonkeyClient(object):
         taking an endpoint string to add to the URI
         and data dict
         Returns a dict
+
+        Every attempt waits for the rate limiter first. Throttled
+        (429) and server error (5xx) responses, timeouts and
+        connection errors are retried up to MAX_RETRIES times
+        with exponential backoff and jitter
         '''
         uri = "%s%s" % (self.HOST, endpoint)
-        response = self.client.post(uri, data=json.dumps(data))
-        response_json = response.json()
-        return response_json
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response = self.client.post(uri, data=json.dumps(data), timeout=self.TIMEOUT)
+            except (requests.Timeout, requests.ConnectionError):
+                if attempt >= self.MAX_RETRIES:
+                    raise
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    response_json = response.json()
+                    return response_json
+                if attempt >= self.MAX_RETRIES:
+                    response.raise_for_status()
+                retry_after = response.headers.get("Retry-After")
+            with self.rate_limiter.lock:
+                self.retries += 1
+            self.rate_limiter.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+        Seconds to wait before retry number attempt + 1:
+        the server's Retry-After if it sent one, otherwise
+        exponential backoff with full jitter
+        '''
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+
+    def _get_counters(self):
+        '''
+        Request counters for monitoring ingestion runs
+        '''
+        return {
+            "requests_today": self.rate_limiter.day_count,
+            "retries": self.retries,
+            "throttled_waits": self.rate_limiter.throttled_waits,
+        }
+    counters = property(_get_counters)
 
     def get_survey_list(self, survey_name):
         '''
@@ -49,11 +209,27 @@ class SurveyMonkeyClient(object):
         Helper method that call get_survey_list() method
         to get a list of survey IDs matching survey_name
         then return the first element in the list
+
+        Resolved IDs are cached on the client for SURVEY_ID_TTL
+        seconds, so a sync resolves each name only once
         '''
+        cached = self._survey_ids.get(survey_name)
+        if cached is not None and (cached[1] is None or cached[1] > time.time()):
+            return cached[0]
         survey_list = self.get_survey_list(survey_name)
         survey_id = survey_list[0]["survey_id"]
+        self.remember_survey_id(survey_name, survey_id, self.SURVEY_ID_TTL)
         return survey_id
 
+    def remember_survey_id(self, survey_name, survey_id, ttl=None):
+        '''
+        Seed the survey ID cache, e.g., with an ID stored in our
+        database, so get_survey_id() skips the get_survey_list call
+        A ttl of None keeps the entry for the life of the client
+        '''
+        expires = time.time() + ttl if ttl is not None else None
+        self._survey_ids[survey_name] = (survey_id, expires)
+
     def get_survey_details(self, survey_name):
         '''
         This method makes a POST request to SurveyMonkey
@@ -66,28 +242,127 @@ class SurveyMonkeyClient(object):
         pages = response_dict["data"]["pages"]
         return pages
 
+    def iter_respondents(self, survey_id, page_size=RESPONDENT_PAGE_SIZE, modified_since=None):
+        '''
+        Generator that pages through the get_respondent_list
+        endpoint for a given survey ID and yields respondent
+        dicts one at a time, requesting page_size per call, e.g.,
+            {u'respondent_id': u'4352787778', u'date_modified': u'2015-11-25 18:02:13'}
+
+        If modified_since (a string in DATE_FORMAT, UTC) is given,
+        only respondents created or modified since then are listed
+        '''
+        RESPONDENT_LIST_ENDPOINT = "/v2/surveys/get_respondent_list"
+        page = 1
+        while True:
+            data = {
+                "survey_id": survey_id,
+                "page": page,
+                "page_size": page_size,
+                "fields": ["date_modified"],
+            }
+            if modified_since:
+                data["start_modified_date"] = modified_since
+            response_dict = self.post_request(RESPONDENT_LIST_ENDPOINT, data)
+            respondents = response_dict["data"]["respondents"]
+            for r in respondents:
+                yield r
+            # A short page means there is nothing left to fetch
+            if len(respondents) < page_size:
+                break
+            page += 1
+
+    def iter_respondent_ids(self, survey_id, page_size=RESPONDENT_PAGE_SIZE):
+        '''
+        Like iter_respondents() but only yields respondent IDs
+        '''
+        for r in self.iter_respondents(survey_id, page_size):
+            yield r["respondent_id"]
+
     def get_respondent_list(self, survey_name):
         '''
-        This method makes a POST request to SurveyMonkey
+        This method makes POST requests to SurveyMonkey
         using get_response_list endpoint and returns a list
         Respondent ID for a given survey
         '''
-        RESPONDENT_LIST_ENDPOINT = "/v2/surveys/get_respondent_list"
-        data = {"survey_id": self.get_survey_id(survey_name)}
-        response_dict = self.post_request(RESPONDENT_LIST_ENDPOINT, data)
-        response_ids = [r["respondent_id"] for r in response_dict["data"]["respondents"]]
-        return response_ids
+        survey_id = self.get_survey_id(survey_name)
+        return list(self.iter_respondent_ids(survey_id))
 
-    def get_responses(self, survey_name):
+    def iter_responses(self, survey_name, batch_size=RESPONSES_BATCH_SIZE, modified_since=None):
         '''
-        This method makes a POST request to SurveyMonkey
-        using get_responses endpoint and returns a list
-        nested response dict for a given survey
+        Streaming version of get_responses(): pages through the
+        respondent list and requests get_responses for batch_size
+        respondents at a time, yielding response dicts one at a
+        time so only one batch is ever held in memory
+
+        Each response dict also carries the respondent's
+        "date_modified" from the respondent list. With
+        modified_since, only respondents created or modified
+        since then are fetched (see iter_respondents())
+
+        The survey ID is resolved before returning, so an unknown
+        survey_name raises IndexError here rather than on first use
+        '''
+        survey_id = self.get_survey_id(survey_name)
+        return self._iter_responses(survey_id, batch_size, modified_since)
+
+    def _iter_responses(self, survey_id, batch_size, modified_since=None):
+        respondents = self.iter_respondents(survey_id, modified_since=modified_since)
+        batches = iter(lambda: list(islice(respondents, batch_size)), [])
+        if self.max_workers > 1:
+            results = self._fetch_concurrently(survey_id, batches)
+        else:
+            results = (self._fetch_batch(survey_id, batch) for batch in batches)
+        for responses in results:
+            for r in responses:
+                yield r
+
+    def _fetch_batch(self, survey_id, respondents):
+        '''
+        fetch_responses() for a batch of respondent list dicts,
+        copying their list fields onto the response dicts
+        '''
+        listed = dict((r["respondent_id"], r) for r in respondents)
+        responses = self.fetch_responses(survey_id, [r["respondent_id"] for r in respondents])
+        for r in responses:
+            for key, value in listed.get(r["respondent_id"], {}).items():
+                r.setdefault(key, value)
+        return responses
+
+    def _fetch_concurrently(self, survey_id, batches):
+        '''
+        Submit _fetch_batch() calls to a pool of max_workers
+        threads, keeping at most max_in_flight batches pending,
+        and yield each batch's responses in submission order
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(self._fetch_batch, survey_id, batch))
+                if len(pending) >= self.max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def fetch_responses(self, survey_id, respondent_ids):
+        '''
+        This method makes a single POST request to SurveyMonkey
+        using get_responses endpoint for a batch of respondent
+        IDs (at most RESPONSES_BATCH_SIZE) and returns a list of
+        nested response dicts
         '''
         RESPONSES_ENDPOINT = "/v2/surveys/get_responses"
         data = {
-            "survey_id": self.get_survey_id(survey_name),
-            "respondent_ids": self.get_respondent_list(survey_name),
+            "survey_id": survey_id,
+            "respondent_ids": respondent_ids,
         }
         response_dict = self.post_request(RESPONSES_ENDPOINT, data)
         return response_dict["data"]
+
+    def get_responses(self, survey_name):
+        '''
+        This method makes POST requests to SurveyMonkey
+        using get_responses endpoint and returns a list
+        nested response dict for a given survey
+        '''
+        return list(self.iter_responses(survey_name))
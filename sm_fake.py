@@ -0,0 +1,261 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from sm_api import SurveyMonkeyClient
+
+
+class FakeSurvey(object):
+    '''
+    A survey as the fake SurveyMonkey API sees it
+
+    pages is the get_survey_details payload, respondents the
+    get_respondent_list entries in listing order, e.g.,
+        [{"respondent_id": "1", "date_modified": "2015-11-25 18:00:00"}]
+    and answers a function returning the "questions" list of
+    get_responses for a respondent ID, so large generated
+    surveys never hold every response in memory
+    '''
+    def __init__(self, name, survey_id, pages, respondents, answers):
+        self.name = name
+        self.survey_id = survey_id
+        self.pages = pages
+        self.respondents = respondents
+        self.answers = answers
+
+
+class FakeSurveyMonkeyAdapter(BaseAdapter):
+    '''
+    requests transport adapter serving the SurveyMonkey v2
+    endpoints SurveyMonkeyClient uses from FakeSurvey objects,
+    so nothing leaves the process. Mount it with
+        SurveyMonkeyClient(token, api_key, transport_adapter=adapter)
+
+    latency seconds are slept before every answer, and every
+    throttle_every-th request is answered 429 Too Many Requests
+    with a Retry-After of retry_after seconds. Requests are
+    recorded in calls as (endpoint, data) tuples
+    '''
+    ENDPOINTS = {
+        "/v2/surveys/get_survey_list": "get_survey_list",
+        "/v2/surveys/get_survey_details": "get_survey_details",
+        "/v2/surveys/get_respondent_list": "get_respondent_list",
+        "/v2/surveys/get_responses": "get_responses",
+    }
+
+    def __init__(self, surveys, latency=0, throttle_every=None, retry_after=0, sleep=time.sleep):
+        super(FakeSurveyMonkeyAdapter, self).__init__()
+        self.surveys = list(surveys)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.sleep = sleep
+        self.calls = []
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        endpoint = requests.compat.urlparse(request.url).path
+        data = json.loads(request.body or "{}")
+        with self.lock:
+            self.calls.append((endpoint, data))
+            throttle = self.throttle_every and len(self.calls) % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        if self.latency:
+            self.sleep(self.latency)
+        if throttle:
+            return self.build_response(request, 429, {"status": 429}, {"Retry-After": str(self.retry_after)})
+        handler = self.ENDPOINTS.get(endpoint)
+        if handler is None:
+            return self.build_response(request, 404, {"status": 404})
+        return self.build_response(request, 200, {"status": 0, "data": getattr(self, handler)(data)})
+
+    def close(self):
+        pass
+
+    def build_response(self, request, status_code, body, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode("utf-8")
+        response.headers = CaseInsensitiveDict(headers or {})
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def survey(self, survey_id):
+        for survey in self.surveys:
+            if survey.survey_id == survey_id:
+                return survey
+        raise KeyError(survey_id)
+
+    def get_survey_list(self, data):
+        # The real API matches titles by case-insensitive substring
+        title = data.get("title", "").lower()
+        return {"surveys": [{"survey_id": s.survey_id} for s in self.surveys if title in s.name.lower()]}
+
+    def get_survey_details(self, data):
+        return {"pages": self.survey(data["survey_id"]).pages}
+
+    def get_respondent_list(self, data):
+        respondents = self.survey(data["survey_id"]).respondents
+        if "start_modified_date" in data:
+            respondents = [r for r in respondents if r["date_modified"] >= data["start_modified_date"]]
+        page_size = data.get("page_size", SurveyMonkeyClient.RESPONDENT_PAGE_SIZE)
+        start = (data.get("page", 1) - 1) * page_size
+        return {"respondents": respondents[start:start + page_size]}
+
+    def get_responses(self, data):
+        survey = self.survey(data["survey_id"])
+        return [{"respondent_id": r, "questions": survey.answers(r)} for r in data["respondent_ids"]]
+
+
+def fake_client(surveys, **kwargs):
+    '''
+    SurveyMonkeyClient talking to a FakeSurveyMonkeyAdapter over
+    surveys, unthrottled unless requests_per_second is given.
+    Other keyword arguments go to the adapter, which is
+    available as client.adapter
+    '''
+    requests_per_second = kwargs.pop("requests_per_second", 10000)
+    max_workers = kwargs.pop("max_workers", 1)
+    adapter = FakeSurveyMonkeyAdapter(surveys, **kwargs)
+    client = SurveyMonkeyClient(
+        "token", "key", max_workers=max_workers,
+        requests_per_second=requests_per_second, transport_adapter=adapter)
+    client.adapter = adapter
+    return client
+
+
+def recorded_adapter():
+    '''
+    Adapter serving recorded_survey(), for the
+    SURVEYMONKEY_TRANSPORT setting
+    '''
+    return FakeSurveyMonkeyAdapter([recorded_survey()])
+
+
+def _question(question_id, heading, family, subtype, answers):
+    return {
+        "question_id": question_id,
+        "heading": heading,
+        "type": {"family": family, "subtype": subtype},
+        "answers": [
+            dict({"answer_id": answer_id, "text": text, "position": n + 1, "visible": True, "type": "row"},
+                 **({"weight": weight} if weight is not None else {}))
+            for n, (answer_id, text, weight) in enumerate(answers)
+        ],
+    }
+
+
+def recorded_survey():
+    '''
+    Replay of the "Mike Test - DO NOT USE" survey: one comment
+    box, a select-all, a select-one and a weighted select-one
+    question answered by 5 respondents
+    '''
+    pages = [{
+        "page_id": "1001",
+        "heading": "",
+        "sub_heading": "",
+        "position": 1,
+        "questions": [
+            _question("2001", "Enter a comment here", "open_ended", "essay", []),
+            _question("2002", "Select-all question", "multiple_choice", "vertical",
+                      [("9002%d" % n, "Option %d" % n, None) for n in range(1, 4)]),
+            _question("2003", "Select-one question", "single_choice", "vertical",
+                      [("9003%d" % n, "Option %d" % n, None) for n in range(1, 4)]),
+            _question("2004", "This is a select-one question with weighting", "single_choice", "vertical",
+                      [("9004%d" % n, "Option %d" % n, n) for n in range(1, 5)] + [("90047", "Not available", 77)]),
+        ],
+    }]
+    # Respondent ID -> (comment, select-all options, select-one option, weighted option)
+    taken = [
+        ("4352787778", "Survey taker 5", [1, 2, 3], 3, 4),
+        ("4352787305", None, [1, 2], 1, 3),
+        ("4352786821", "Survey taker 3", [1, 3], 2, 2),
+        ("4352786417", "Survey taker 2", [2, 3], 2, 7),
+        ("4352785923", "Survey taker 1", [1, 2, 3], 1, 7),
+    ]
+    answers = {}
+    respondents = []
+    for n, (respondent_id, comment, select_all, select_one, weighted) in enumerate(taken):
+        questions = []
+        if comment:
+            questions.append({"question_id": "2001", "answers": [{"row": "0", "text": comment}]})
+        questions.append({"question_id": "2002", "answers": [{"row": "9002%d" % o} for o in select_all]})
+        questions.append({"question_id": "2003", "answers": [{"row": "9003%d" % select_one}]})
+        questions.append({"question_id": "2004", "answers": [{"row": "9004%d" % weighted}]})
+        answers[respondent_id] = questions
+        respondents.append({
+            "respondent_id": respondent_id,
+            "date_modified": "2015-11-25 18:%02d:00" % (10 - n),
+        })
+    return FakeSurvey("Mike Test - DO NOT USE", "72140246", pages, respondents, answers.get)
+
+
+def generate_survey(name="Synthetic survey", survey_id="1", n_questions=10, n_choices=5,
+                    n_respondents=100, open_ended_share=0.1, multi_select_share=0.2,
+                    nps=True, seed=0):
+    '''
+    FakeSurvey with n_questions questions (an NPS question first
+    if nps, then open_ended_share of them comment boxes,
+    multi_select_share select-all and the rest select-one with
+    n_choices weighted choices) and n_respondents respondents
+    answering every question, modified over the year 2015
+
+    Answers are drawn from a generator seeded by seed and the
+    respondent's position, so they are reproduced on every
+    request without being stored
+    '''
+    n_open = int(round(n_questions * open_ended_share))
+    n_multi = int(round(n_questions * multi_select_share))
+    questions = []
+    for n in range(n_questions):
+        question_id = "%s%04d" % (survey_id, n)
+        if nps and n == 0:
+            kind = "nps"
+            choices = [("%s%02d" % (question_id, w), str(w), w) for w in range(11)]
+            question = _question(question_id, "How likely are you to recommend us to a friend?",
+                                 "single_choice", "horiz", choices)
+        elif n > n_questions - 1 - n_open:
+            kind = "open_ended"
+            question = _question(question_id, "Comment %d" % n, "open_ended", "essay", [])
+        else:
+            kind = "multiple_choice" if n > n_questions - 1 - n_open - n_multi else "single_choice"
+            choices = [("%s%02d" % (question_id, c), "Choice %d" % c, c) for c in range(1, n_choices + 1)]
+            question = _question(question_id, "Question %d" % n, kind, "vertical", choices)
+        questions.append((kind, question))
+    pages = [{"page_id": survey_id, "heading": "", "sub_heading": "", "position": 1,
+              "questions": [q for kind, q in questions]}]
+
+    start = datetime(2015, 1, 1)
+    step = timedelta(days=365) // max(n_respondents, 1)
+    respondents = [
+        {"respondent_id": "%s%07d" % (survey_id, n),
+         "date_modified": (start + step * n).strftime(SurveyMonkeyClient.DATE_FORMAT)}
+        for n in range(n_respondents)
+    ]
+    positions = dict((r["respondent_id"], n) for n, r in enumerate(respondents))
+
+    def answers(respondent_id):
+        rng = random.Random(seed * 1000003 + positions[respondent_id])
+        result = []
+        for kind, question in questions:
+            choice_ids = [a["answer_id"] for a in question["answers"]]
+            if kind == "open_ended":
+                picked = [{"row": "0", "text": "Respondent %s says %d" % (respondent_id, rng.randint(0, 999))}]
+            elif kind == "multiple_choice":
+                picked = [{"row": c} for c in choice_ids if rng.random() < 0.4] or [{"row": choice_ids[0]}]
+            else:
+                picked = [{"row": rng.choice(choice_ids)}]
+            result.append({"question_id": question["question_id"], "answers": picked})
+        return result
+
+    return FakeSurvey(name, survey_id, pages, respondents, answers)